@@ -1,14 +1,19 @@
 # prerequisites
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
-from torchvision import datasets, transforms
-import pickle
+from torch.func import functional_call, vmap, grad
+import numpy as np
+import json
 import tqdm
 import argparse
 import logging
 import os
 
-from model import OneHotCVAE, loss_function
+from model import OneHotCVAE, CapacityCVAE, loss_function, model_from_state_dict
+from dataset import MNIST_Custom
+from utils import remap_param_dict
+from tensor_io import load_checkpoint, save_fisher_dict
 
 
 def parse_args_and_ckpt():
@@ -22,71 +27,360 @@ def parse_args_and_ckpt():
         "--n_fim_samples", type=int, default=50000, help="Number of samples to calculate FIM with. Only applicable for true FIM."
     )
     
+    parser.add_argument(
+        "--fim_batch_size", type=int, default=1000, help="Number of samples per vectorized per-sample gradient pass"
+    )
+
+    parser.add_argument(
+        "--fim_method", type=str, default="vmap", choices=["vmap", "analytic", "kfac"], help="vmap : vectorized per-sample gradients, analytic : per-layer outer products from hooked activations (lower memory), kfac : Kronecker factors saved to kfac_dict.tensors (and their diagonal)"
+    )
+
+    parser.add_argument(
+        "--fim_tol", type=float, default=None, help="Stop the FIM estimation once its relative standard error is below this tolerance, n_fim_samples becomes the cap"
+    )
+
+    parser.add_argument(
+        "--n_workers", type=int, default=1, help="Number of CPU worker processes the FIM samples are sharded over (1 computes it in process)"
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the worker RNG streams (one independent stream per worker, spawned from it) for the sharded FIM"
+    )
+    
     args = parser.parse_args()
-    ckpt = torch.load(os.path.join(args.ckpt_folder, "ckpts/ckpt.pt"), map_location=device)
+    ckpt = load_checkpoint(os.path.join(args.ckpt_folder, "ckpts/ckpt"), device=device)
     
     return args, ckpt
 
 
-def save_fim(vae, args, config, device):
-    fisher_dict = {}
-    params_mle_dict = {}
-    
-    for name, param in vae.named_parameters():
-        params_mle_dict[name] = param.data.clone()
-        fisher_dict[name] = param.data.clone().zero_()
-    
-    for _ in tqdm.tqdm(range(args.n_fim_samples)):
-        
-        with torch.no_grad():
-            z = torch.randn(1, config.z_dim).to(device)
-            c = torch.randint(0,10, (1,)).to(device)
-            c = F.one_hot(c, 10)
-            vae.eval()
-            sample = vae.decoder(z, c)
-        
-        vae.train()
-        vae.zero_grad()
+def sample_fim_batch(vae, config, device, batch_size, labels=None):
+    # conditional samples drawn from the model itself, the FIM is estimated on these
+    labels = torch.as_tensor(list(range(10)) if labels is None else list(labels), device=device)
+    with torch.no_grad():
+        vae.eval()
+        z = torch.randn(batch_size, config.z_dim, device=device)
+        c = labels[torch.randint(0, labels.shape[0], (batch_size,), device=device)]
+        # one-hot conditioning so that the sample stays a plain tensor input under vmap
+        # and fc1 / fc4 are called as modules, which the hooks of analytic_fim_sums rely on
+        c = F.one_hot(c, 10).float()
+        sample = vae.decoder(z, c)
+    vae.train()
+    return sample, c
+
+
+def per_sample_fim_sums(vae, sample, c):
+    # sum over the batch of the squared per-sample gradients of the VAE loss,
+    # the per-sample gradients come from one vmap'd grad call instead of one backward pass per sample
+    params = {name: param.detach() for name, param in vae.named_parameters()}
+    buffers = {name: buffer.detach() for name, buffer in vae.named_buffers()}
+
+    def sample_loss(params, x, c):
+        x, c = x.unsqueeze(0), c.unsqueeze(0)
+        recon_batch, mu, log_var = functional_call(vae, (params, buffers), (x, c))
+        return loss_function(recon_batch, x, mu, log_var)
+
+    grads = vmap(grad(sample_loss), in_dims=(None, 0, 0), randomness='different')(params, sample, c)
+    return {name: g.pow(2).sum(dim=0) for name, g in grads.items()}
+
+
+def linear_inputs_and_output_grads(vae, sample, c):
+    # {layer_name: (a, g)} for every nn.Linear of vae, a the (B, in) layer input and g the (B, out) grad of the summed
+    # batch loss w.r.t. the layer output, from forward hooks and one batched backward
+    # the loss is a sum of per-sample terms, so row i of g is sample i's own delta
+    if isinstance(vae, CapacityCVAE):
+        raise ValueError("CapacityCVAE does not call its nn.Linear modules, compact() it first or use the vmap FIM")
+    layers = {name: module for name, module in vae.named_modules() if isinstance(module, nn.Linear)}
+    inputs, outputs = {}, {}
+
+    def capture(name):
+        def hook(module, args, output):
+            inputs[name] = args[0].detach()
+            outputs[name] = output
+        return hook
+
+    handles = [layer.register_forward_hook(capture(name)) for name, layer in layers.items()]
+    try:
         recon_batch, mu, log_var = vae(sample, c)
-        loss = loss_function(recon_batch, sample, mu, log_var)
-        loss.backward()
-
-        for name, param in vae.named_parameters():
-            if torch.isnan(param.grad.data).any():
-                print("NAN detected")
-            fisher_dict[name] += ((param.grad.data) ** 2) / args.n_fim_samples
-        
-    with open(os.path.join(config.exp_root_dir, 'fisher_dict.pkl'), 'wb') as f:
-        pickle.dump(fisher_dict, f)
+    finally:
+        for handle in handles:
+            handle.remove()
+    if len(outputs) == 0:
+        raise ValueError(f"None of the nn.Linear layers of {type(vae).__name__} was called by its forward pass, their hooks give no FIM")
+
+    loss = loss_function(recon_batch, sample, mu, log_var)
+    names = [name for name in layers if name in outputs]
+    output_grads = torch.autograd.grad(loss, [outputs[name] for name in names])
+    return {name: (inputs[name], g) for name, g in zip(names, output_grads)}
+
+
+def analytic_fim_sums(vae, sample, c):
+    # same sums as per_sample_fim_sums for a model made only of nn.Linear layers : the per-sample gradient of a weight
+    # is the outer product of the layer's output grad g and input a, so sum_i (g_i a_i^T)^2 = (g^2)^T (a^2),
+    # formed without materializing any per-sample gradient
+    fim_sums = {}
+    for name, (a, g) in linear_inputs_and_output_grads(vae, sample, c).items():
+        g_sq = g.pow(2)
+        fim_sums[f"{name}.weight"] = g_sq.t() @ a.pow(2)
+        fim_sums[f"{name}.bias"] = g_sq.sum(dim=0)
+    return fim_sums
+
+
+def kfac_sums(vae, sample, c):
+    # per nn.Linear layer sums of a_aug a_aug^T (input with a constant 1 appended for the bias) and g g^T,
+    # the Kronecker factors A and G of the layer's Fisher block F ~ A (x) G once divided by the number of samples
+    # keyed "<layer>.A" / "<layer>.G", see kfac_factors for the nested kfac_dict
+    factor_sums = {}
+    for name, (a, g) in linear_inputs_and_output_grads(vae, sample, c).items():
+        a_aug = torch.cat([a, torch.ones_like(a[:, :1])], dim=1)
+        factor_sums[f"{name}.A"] = a_aug.t() @ a_aug
+        factor_sums[f"{name}.G"] = g.t() @ g
+    return factor_sums
+
+
+FIM_METHODS = {
+    'vmap': per_sample_fim_sums,
+    'analytic': analytic_fim_sums,
+    'kfac': kfac_sums,
+}
+
+
+# batches needed before the spread of the batch means is trusted for early stopping
+FIM_MIN_BATCHES = 3
+
+
+def fim_sums_over_samples(vae, config, device, n_samples, fim_batch_size=1000, labels=None, method='vmap', tol=None):
+    # sums of the squared per-sample gradients over at most n_samples model samples, drawn and differentiated fim_batch_size at a time
+    # method picks how the per-batch sums are formed, see FIM_METHODS (for kfac the sums are those of the Kronecker factors)
+    # with tol, sampling stops as soon as the relative standard error of the estimate is at most tol (n_samples is the hard cap)
+    # returns the sums, the number of samples they hold and the relative standard error reached (None below 2 batches)
+    fim_sums = FIM_METHODS[method]
+    sums, means_sum, means_sq_sum = {}, {}, {}
+    n_done, rel_err = 0, None
+
+    n_batches = (n_samples + fim_batch_size - 1) // fim_batch_size
+    pbar = tqdm.tqdm(range(n_batches))
+    for i in pbar:
+        batch_size = min(fim_batch_size, n_samples - i * fim_batch_size)
+        sample, c = sample_fim_batch(vae, config, device, batch_size, labels)
+        for name, sq_grad in fim_sums(vae, sample, c).items():
+            if name not in sums:
+                sums[name] = torch.zeros_like(sq_grad)
+                means_sum[name] = torch.zeros_like(sq_grad)
+                means_sq_sum[name] = torch.zeros_like(sq_grad)
+            sums[name] += sq_grad
+            batch_mean = sq_grad / batch_size
+            means_sum[name] += batch_mean
+            means_sq_sum[name] += batch_mean ** 2
+        n_done += batch_size
+
+        if i >= 1:
+            rel_err = relative_standard_error(means_sum, means_sq_sum, i + 1)
+            pbar.set_postfix(rel_err=rel_err)
+            if tol is not None and i + 1 >= FIM_MIN_BATCHES and rel_err <= tol:
+                break
+    return sums, n_done, rel_err
+
+
+def relative_standard_error(means_sum, means_sq_sum, n_batches):
+    # ||SE|| / ||mean|| over all the entries of the FIM estimate (batch-means method) : the standard error of every entry
+    # is the standard deviation of its n_batches batch means over sqrt(n_batches)
+    se_sq, mean_sq = 0, 0
+    for name in means_sum:
+        mean = means_sum[name] / n_batches
+        var = (means_sq_sum[name] / n_batches - mean ** 2).clamp(min=0) * n_batches / (n_batches - 1)
+        se_sq += var.sum() / n_batches
+        mean_sq += mean.pow(2).sum()
+    if mean_sq == 0:
+        return 0.
+    return float((se_sq / mean_sq).sqrt())
+
+
+def check_fim(fisher_dict):
+    for name in fisher_dict:
+        if not torch.isfinite(fisher_dict[name]).all():
+            logging.warning(f"NAN detected in the FIM of {name}")
+
+
+def compute_fim(vae, config, device, n_fim_samples, fim_batch_size=1000, labels=None, method='vmap', tol=None, return_info=False):
+    # diagonal FIM over n_fim_samples model samples, or fewer once the relative standard error reaches tol
+    # return_info=True also returns {'n_samples', 'rel_err'} of the estimate
+    fisher_dict, n_done, rel_err = fim_sums_over_samples(vae, config, device, n_fim_samples, fim_batch_size, labels, method, tol)
+    for name in fisher_dict:
+        fisher_dict[name] /= n_done
+    check_fim(fisher_dict)
+    if return_info:
+        return fisher_dict, {'n_samples': n_done, 'rel_err': rel_err}
+    return fisher_dict
+
+
+def _fim_shard(rank, state_dict, config, n_samples, fim_batch_size, labels, method, tol, seed, n_threads):
+    # worker of compute_fim_sharded : its own CPU copy of the model and its own RNG stream (seed of the rank, see shard_seeds)
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(seed)
+    vae = model_from_state_dict(state_dict)
+    vae.train()
+    return fim_sums_over_samples(vae, config, torch.device('cpu'), n_samples, fim_batch_size, labels, method, tol)
+
+
+def shard_seeds(seed, n_workers):
+    # independent per-rank seeds spawned from seed, so the streams of neighbouring seeds (or worker counts) do not overlap
+    return [int(child.generate_state(1, dtype=np.uint64)[0]) for child in np.random.SeedSequence(seed).spawn(n_workers)]
+
+
+def compute_fim_sharded(vae, config, n_fim_samples, n_workers, seed=0, fim_batch_size=1000, labels=None, method='vmap', tol=None, return_info=False):
+    # compute_fim split over n_workers CPU processes, each estimating a shard of the samples, the partial sums are reduced
+    # in rank order so the result only depends on seed and n_workers
+    if isinstance(vae, CapacityCVAE):
+        # the workers rebuild a plain OneHotCVAE from the state dict, which would drop the active neuron masks
+        raise ValueError("compute_fim_sharded does not support CapacityCVAE, compact() it first")
+    state_dict = {name: tensor.detach().cpu() for name, tensor in vae.state_dict().items()}
+    shard_sizes = [n_fim_samples // n_workers + (rank < n_fim_samples % n_workers) for rank in range(n_workers)]
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+
+    seeds = shard_seeds(seed, n_workers)
+    shards = [(rank, state_dict, config, shard_sizes[rank], fim_batch_size, labels, method, tol, seeds[rank], n_threads) for rank in range(n_workers)]
+    with torch.multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+        results = pool.starmap(_fim_shard, shards)
+
+    device = next(vae.parameters()).device
+    n_done = sum(shard_n_done for _, shard_n_done, _ in results)
+    fisher_dict = {}
+    for name in results[0][0]:
+        fisher_dict[name] = results[0][0][name].clone()
+        for sums, _, _ in results[1:]:
+            fisher_dict[name] += sums[name]
+        fisher_dict[name] = (fisher_dict[name] / n_done).to(device)
+    check_fim(fisher_dict)
+    if return_info:
+        # the largest relative standard error of the shards, the pooled estimate is at least as accurate
+        shard_errors = [rel_err for _, _, rel_err in results if rel_err is not None]
+        return fisher_dict, {'n_samples': n_done, 'rel_err': max(shard_errors) if shard_errors else None, 'n_workers': n_workers, 'seed': seed}
+    return fisher_dict
+
+
+def kfac_factors(factor_dict):
+    # {layer_name: {'A': (in + 1, in + 1), 'G': (out, out)}} from the flat factors of compute_fim(method='kfac'), O(layer dims^2) storage
+    kfac_dict = {}
+    for key, factor in factor_dict.items():
+        name, factor_name = key.rsplit('.', 1)
+        kfac_dict.setdefault(name, {})[factor_name] = factor
+    return kfac_dict
+
+
+def kfac_diagonal(kfac_dict):
+    # diagonal of A (x) G in the fisher_dict layout : F[W_ij] = G_ii A_jj and F[b_i] = G_ii A_bias,bias
+    fisher_dict = {}
+    for name, factors in kfac_dict.items():
+        diag_A, diag_G = torch.diagonal(factors['A']), torch.diagonal(factors['G'])
+        fisher_dict[f"{name}.weight"] = torch.outer(diag_G, diag_A[:-1])
+        fisher_dict[f"{name}.bias"] = diag_G * diag_A[-1]
+    return fisher_dict
+
+
+class OnlineFisher:
+    # running diagonal FIM kept as per-class sums of squared per-sample gradients and sample counts,
+    # so a phase only pays for the classes it adds and forgotten classes are subtracted exactly
+    def __init__(self, decay=1.0):
+        # decay < 1 down-weights the classes estimated in earlier phases each time new ones are added
+        self.decay = decay
+        self.class_sums = {}
+        self.class_counts = {}
+        # relative standard error reached by the last estimate of each class
+        self.class_errors = {}
+
+    @property
+    def classes(self):
+        return sorted(self.class_sums)
+
+    def shapes_match(self, vae):
+        params = dict(vae.named_parameters())
+        return all(
+            sums.keys() == params.keys() and all(sums[name].shape == params[name].shape for name in sums)
+            for sums in self.class_sums.values()
+        )
+
+    def remap(self, index_maps):
+        # follows a prune / expand of the model (utils.remap_param_dict), the neurons added by an expansion start with zero importance
+        for label in self.class_sums:
+            self.class_sums[label] = remap_param_dict(self.class_sums[label], index_maps)
+
+    def remove_classes(self, labels):
+        for label in labels:
+            self.class_sums.pop(int(label), None)
+            self.class_counts.pop(int(label), None)
+            self.class_errors.pop(int(label), None)
+
+    def update(self, vae, config, device, labels, n_samples_per_class, fim_batch_size=1000, method='vmap', tol=None):
+        # adds up to n_samples_per_class samples of each label at the current parameters (fewer once tol is reached)
+        labels = [int(label) for label in labels]
+        if not self.shapes_match(vae):
+            # the architecture changed since the stored classes were estimated, they are re-estimated from scratch
+            logging.info(f"FIM shapes changed, re-estimating classes {self.classes}")
+            labels = sorted(set(labels) | set(self.class_sums))
+            self.class_sums, self.class_counts, self.class_errors = {}, {}, {}
+        if len(labels) == 0:
+            return
+
+        if self.decay != 1:
+            for label in self.class_sums:
+                for name in self.class_sums[label]:
+                    self.class_sums[label][name] *= self.decay
+                self.class_counts[label] *= self.decay
+
+        for label in labels:
+            sums, n_done, rel_err = fim_sums_over_samples(vae, config, device, n_samples_per_class, fim_batch_size, [label], method, tol)
+            if label in self.class_sums:
+                for name in sums:
+                    self.class_sums[label][name] += sums[name]
+                self.class_counts[label] += n_done
+            else:
+                self.class_sums[label] = sums
+                self.class_counts[label] = n_done
+            self.class_errors[label] = rel_err
+
+    def fisher(self):
+        # FIM pooled over all the stored samples, with equal per-class counts this is uniform sampling of the stored labels
+        if len(self.class_sums) == 0:
+            return {}
+        total = sum(self.class_counts.values())
+        fisher_dict = {}
+        for name in self.class_sums[self.classes[0]]:
+            fisher_dict[name] = sum(sums[name] for sums in self.class_sums.values()) / total
+        check_fim(fisher_dict)
+        return fisher_dict
+
+    def info(self):
+        return {'classes': {label: {'n_samples': self.class_counts[label], 'rel_err': self.class_errors.get(label)} for label in self.classes},
+                'n_samples': sum(self.class_counts.values())}
+
+
+def save_fim(vae, args, config, device):
+    if args.n_workers > 1:
+        fisher_dict, info = compute_fim_sharded(vae, config, args.n_fim_samples, args.n_workers, args.seed, args.fim_batch_size, method=args.fim_method, tol=args.fim_tol, return_info=True)
+    else:
+        fisher_dict, info = compute_fim(vae, config, device, args.n_fim_samples, args.fim_batch_size, method=args.fim_method, tol=args.fim_tol, return_info=True)
+    if args.fim_method == 'kfac':
+        # the Kronecker factors go to kfac_dict.tensors for KFACPenalty, fisher_dict.tensors gets their diagonal
+        kfac_dict = kfac_factors(fisher_dict)
+        save_fisher_dict(config.exp_root_dir, kfac_dict, name='kfac_dict')
+        fisher_dict = kfac_diagonal(kfac_dict)
+    logging.info(f"FIM estimated from {info['n_samples']} samples, relative standard error {info['rel_err']}")
+
+    save_fisher_dict(config.exp_root_dir, fisher_dict)
+    # sample count and error reached, next to the FIM they describe
+    with open(os.path.join(config.exp_root_dir, 'fisher_info.json'), 'w') as f:
+        json.dump(dict(info, method=args.fim_method, tol=args.fim_tol, max_samples=args.n_fim_samples), f, indent=4)
     # with open(os.path.join(config.exp_root_dir, 'params_mle_dict.pkl'), 'wb') as f:
     #     pickle.dump(params_mle_dict, f)
 
 
 def one_class_mnist_dataset(class_label):
 
-    train_dataset = datasets.MNIST(
-        './dataset',
-        train=True,
-        download=True,
-        transform=transforms.ToTensor(),
-    )
-    
-    test_dataset = datasets.MNIST(
-        './dataset',
-        train=False,
-        download=True,
-        transform=transforms.ToTensor(),
-    )
-
-    def find_indices(lst, condition):
-        return [i for i, elem in enumerate(lst) if elem == condition]
-
-    train_idx = find_indices(train_dataset.targets, class_label)
-    train_subset = torch.utils.data.Subset(train_dataset, train_idx)
+    # served from the memory-mapped MNIST cache, see dataset.build_mnist_cache
+    train_subset = MNIST_Custom(digits=[class_label], data_path='./dataset', train=True, download=True, in_memory=True)
     train_loader = torch.utils.data.DataLoader(train_subset, batch_size=1, shuffle=True, drop_last=False)
     
-    test_idx = find_indices(test_dataset.targets, class_label)
-    test_subset = torch.utils.data.Subset(test_dataset, test_idx)
+    test_subset = MNIST_Custom(digits=[class_label], data_path='./dataset', train=False, download=True, in_memory=True)
     test_loader = torch.utils.data.DataLoader(test_subset, batch_size=1, shuffle=True, drop_last=False)
     
     return train_loader, test_loader
@@ -103,4 +397,4 @@ if __name__ == "__main__":
 
     vae.load_state_dict(ckpt['model'])
     vae.train()
-    save_fim()
\ No newline at end of file
+    save_fim(vae, args, config, device)
\ No newline at end of file
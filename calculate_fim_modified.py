@@ -1,14 +1,13 @@
 # prerequisites
 import torch
-import torch.nn.functional as F
-from torchvision import datasets, transforms
-import pickle
-import tqdm
 import argparse
 import logging
 import os
 
-from model import OneHotCVAE, loss_function
+from model import OneHotCVAE
+from dataset import MNIST_Custom
+from calculate_fim import save_fim
+from tensor_io import load_checkpoint
 
 
 def parse_args_and_ckpt():
@@ -22,71 +21,39 @@ def parse_args_and_ckpt():
         "--n_fim_samples", type=int, default=50000, help="Number of samples to calculate FIM with. Only applicable for true FIM."
     )
     
-    args = parser.parse_args()
-    ckpt = torch.load(os.path.join(args.ckpt_folder, "ckpts/ckpt_modified.pt"), map_location=device)
-    
-    return args, ckpt
-
-
-def save_fim():
-    fisher_dict = {}
-    params_mle_dict = {}
-    
-    for name, param in vae.named_parameters():
-        params_mle_dict[name] = param.data.clone()
-        fisher_dict[name] = param.data.clone().zero_()
-    
-    for _ in tqdm.tqdm(range(args.n_fim_samples)):
-        
-        with torch.no_grad():
-            z = torch.randn(1, config.z_dim).to(device)
-            c = torch.randint(0,10, (1,)).to(device)
-            c = F.one_hot(c, 10)
-            vae.eval()
-            sample = vae.decoder(z, c)
-        
-        vae.train()
-        vae.zero_grad()
-        recon_batch, mu, log_var = vae(sample, c)
-        loss = loss_function(recon_batch, sample, mu, log_var)
-        loss.backward()
+    parser.add_argument(
+        "--fim_batch_size", type=int, default=1000, help="Number of samples per vectorized per-sample gradient pass"
+    )
 
-        for name, param in vae.named_parameters():
-            if torch.isnan(param.grad.data).any():
-                print("NAN detected")
-            fisher_dict[name] += ((param.grad.data) ** 2) / args.n_fim_samples
-        
-    with open(os.path.join(config.exp_root_dir, 'fisher_dict.pkl'), 'wb') as f:
-        pickle.dump(fisher_dict, f)
-    # with open(os.path.join(config.exp_root_dir, 'params_mle_dict.pkl'), 'wb') as f:
-    #     pickle.dump(params_mle_dict, f)
+    parser.add_argument(
+        "--fim_method", type=str, default="vmap", choices=["vmap", "analytic", "kfac"], help="vmap : vectorized per-sample gradients, analytic : per-layer outer products from hooked activations (lower memory), kfac : Kronecker factors saved to kfac_dict.tensors (and their diagonal)"
+    )
 
+    parser.add_argument(
+        "--fim_tol", type=float, default=None, help="Stop the FIM estimation once its relative standard error is below this tolerance, n_fim_samples becomes the cap"
+    )
 
-def one_class_mnist_dataset(class_label):
+    parser.add_argument(
+        "--n_workers", type=int, default=1, help="Number of CPU worker processes the FIM samples are sharded over (1 computes it in process)"
+    )
 
-    train_dataset = datasets.MNIST(
-        './dataset',
-        train=True,
-        download=True,
-        transform=transforms.ToTensor(),
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the worker RNG streams (one independent stream per worker, spawned from it) for the sharded FIM"
     )
     
-    test_dataset = datasets.MNIST(
-        './dataset',
-        train=False,
-        download=True,
-        transform=transforms.ToTensor(),
-    )
+    args = parser.parse_args()
+    ckpt = load_checkpoint(os.path.join(args.ckpt_folder, "ckpts/ckpt_modified"), device=device)
+    
+    return args, ckpt
 
-    def find_indices(lst, condition):
-        return [i for i, elem in enumerate(lst) if elem == condition]
 
-    train_idx = find_indices(train_dataset.targets, class_label)
-    train_subset = torch.utils.data.Subset(train_dataset, train_idx)
+def one_class_mnist_dataset(class_label):
+
+    # served from the memory-mapped MNIST cache, see dataset.build_mnist_cache
+    train_subset = MNIST_Custom(digits=[class_label], data_path='./dataset', train=True, download=True, in_memory=True)
     train_loader = torch.utils.data.DataLoader(train_subset, batch_size=1, shuffle=True, drop_last=False)
     
-    test_idx = find_indices(test_dataset.targets, class_label)
-    test_subset = torch.utils.data.Subset(test_dataset, test_idx)
+    test_subset = MNIST_Custom(digits=[class_label], data_path='./dataset', train=False, download=True, in_memory=True)
     test_loader = torch.utils.data.DataLoader(test_subset, batch_size=1, shuffle=True, drop_last=False)
     
     return train_loader, test_loader
@@ -103,4 +70,4 @@ if __name__ == "__main__":
 
     vae.load_state_dict(ckpt['model'])
     vae.train()
-    save_fim()
\ No newline at end of file
+    save_fim(vae, args, config, device)
\ No newline at end of file
@@ -2,13 +2,102 @@ import torch
 from torch.utils.data import Dataset, DataLoader
 from torchvision import datasets, transforms
 import numpy as np
+import argparse
+import os
+
+MNIST_CACHE_FOLDER = os.path.join("MNIST", "cache")
+
+def mnist_cache_paths(data_path, train=True):
+    split = "train" if train else "test"
+    cache_dir = os.path.join(data_path, MNIST_CACHE_FOLDER)
+    return (
+        os.path.join(cache_dir, f"{split}_images.npy"),
+        os.path.join(cache_dir, f"{split}_labels.npy"),
+        os.path.join(cache_dir, f"{split}_class_index.npz"),
+    )
+
+def _save_atomic(path, save_fn):
+    # write to a temporary file first so that parallel runs never open a half written shard
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        save_fn(f)
+    os.replace(tmp_path, path)
+
+def build_mnist_cache(data_path, download=True):
+    # one time conversion of the raw idx files into normalized float32 images, int64 labels and a per-class index
+    os.makedirs(os.path.join(data_path, MNIST_CACHE_FOLDER), exist_ok=True)
+    for train in (True, False):
+        images_path, labels_path, index_path = mnist_cache_paths(data_path, train)
+        if all(os.path.exists(path) for path in (images_path, labels_path, index_path)):
+            continue
+
+        mnist = datasets.MNIST(root=data_path, train=train, transform=None, download=download)
+        # same scaling as transforms.ToTensor()
+        images = mnist.data.unsqueeze(1).numpy().astype(np.float32) / 255
+        labels = mnist.targets.numpy().astype(np.int64)
+        class_index = {str(digit): np.flatnonzero(labels == digit) for digit in range(10)}
+
+        _save_atomic(images_path, lambda f: np.save(f, images))
+        _save_atomic(labels_path, lambda f: np.save(f, labels))
+        _save_atomic(index_path, lambda f: np.savez(f, **class_index))
+
+def load_mnist_cache(data_path, train=True, download=True):
+    # opens the cached split zero-copy : the arrays are copy-on-write memory maps, so every process shares the page cache
+    images_path, labels_path, index_path = mnist_cache_paths(data_path, train)
+    if not all(os.path.exists(path) for path in (images_path, labels_path, index_path)):
+        build_mnist_cache(data_path, download=download)
+
+    images = torch.from_numpy(np.load(images_path, mmap_mode='c'))
+    labels = torch.from_numpy(np.load(labels_path, mmap_mode='c'))
+    with np.load(index_path) as index:
+        class_index = {int(digit): torch.from_numpy(index[digit]) for digit in index.files}
+    return images, labels, class_index
+
+class MNISTClassIndex:
+    # digit -> train / test row indices of the MNIST cache, built once so that any label set resolves without a rescan
+    def __init__(self, data_path, download=True):
+        self.data_path = data_path
+        self.splits = {train: load_mnist_cache(data_path, train=train, download=download) for train in (True, False)}
+
+    def rows(self, digits, train=True):
+        _, _, class_index = self.splits[train]
+        digits = sorted(set(int(digit) for digit in digits))
+        if len(digits) == 0:
+            return torch.zeros(0, dtype=torch.long)
+        return torch.cat([class_index[digit] for digit in digits])
+
+    def subset(self, digits, train=True):
+        # O(selected rows) gather of the images and labels of the given digits
+        images, labels, _ = self.splits[train]
+        rows = self.rows(digits, train)
+        if rows.shape[0] == labels.shape[0]:
+            # all digits selected, keep the zero-copy views of the cache
+            return images, labels, rows
+        return images[rows], labels[rows], rows
+
+_CLASS_INDEX = {}
+
+def get_class_index(data_path, download=True):
+    # one MNISTClassIndex per data_path for the lifetime of the process
+    key = os.path.abspath(data_path)
+    if key not in _CLASS_INDEX:
+        _CLASS_INDEX[key] = MNISTClassIndex(data_path, download=download)
+    return _CLASS_INDEX[key]
 
 class MNIST_Custom(Dataset):
-    def __init__(self, digits, data_path, train=True, transform=None, download=True):
+    def __init__(self, digits, data_path, train=True, transform=None, download=True, in_memory=False):
         self.digits = digits
         self.data_path = data_path
         self.train = train
         self.transform = transform
+        self.in_memory = in_memory
+
+        if self.in_memory:
+            # served from the memory-mapped cache (see build_mnist_cache) as (N, 1, 28, 28) float tensors, scaled like transforms.ToTensor()
+            # rows are resolved through the shared per-class index, so no label scan happens per instance
+            # transform is ignored in this mode, items are served by plain tensor indexing
+            self.data, self.targets, self.indices = get_class_index(self.data_path, download=download).subset(digits, train=self.train)
+            return
 
         # Load MNIST dataset
         if self.train:
@@ -16,13 +105,17 @@ class MNIST_Custom(Dataset):
         else:
             self.dataset = datasets.MNIST(root=self.data_path, train=False, transform=None, download=False)
 
-        # Filter dataset to include only specified digits
-        self.indices = [i for i, (image, label) in enumerate(self.dataset) if label in digits]
+        # Filter dataset to include only specified digits (on the label tensor, no image decoding)
+        mask = torch.isin(self.dataset.targets, torch.as_tensor(list(digits), dtype=self.dataset.targets.dtype))
+        self.indices = torch.nonzero(mask).squeeze(1).tolist()
 
     def __len__(self):
         return len(self.indices)
 
     def __getitem__(self, idx):
+        if self.in_memory:
+            return self.data[idx], self.targets[idx]
+
         idx = self.indices[idx]
         image, label = self.dataset[idx]
 
@@ -31,7 +124,45 @@ class MNIST_Custom(Dataset):
 
         return image, label
 
+NOISE_PROB = 0.09
+NOISE_LABEL = 10
+
+def add_noise_to_batch(data, labels, noise_prob=NOISE_PROB, noise_label=NOISE_LABEL):
+    # batch level version of MNIST_Custom_Noisy.__getitem__ : one vectorized Bernoulli draw picks the noise rows,
+    # which are overwritten in place with N(0, 1) images and relabelled as noise_label
+    noisy = torch.rand(labels.shape[0], device=labels.device) < noise_prob
+    data[noisy] = torch.randn((int(noisy.sum()),) + tuple(data.shape[1:]), device=data.device, dtype=data.dtype)
+    labels[noisy] = noise_label
+    return data, labels
+
+class _InMemoryLoader:
+    # batches of an in_memory dataset sliced from one torch.randperm per epoch, as utils.cycle_tensors does
+    # exposes .dataset and len() like the DataLoader it replaces
+    def __init__(self, dataset, batch_size, shuffle=True, noisy=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.noisy = noisy
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for start in range(0, n, self.batch_size):
+            idx = order[start:start + self.batch_size]
+            data, targets = self.dataset.data[idx], self.dataset.targets[idx]
+            if self.noisy:
+                data, targets = add_noise_to_batch(data, targets)
+            yield data, targets
+
+def in_memory_loader(dataset, batch_size, shuffle=True, noisy=False):
+    # loader over an MNIST_Custom(in_memory=True) that gathers whole batches with one tensor index instead of collating single items
+    return _InMemoryLoader(dataset, batch_size, shuffle=shuffle, noisy=noisy)
+
 class MNIST_Custom_Noisy(Dataset):
+    # per item noise class, for batches of preloaded tensors use add_noise_to_batch / in_memory_loader(noisy=True)
     def __init__(self, digits, data_path, train=True, transform=None, download=True):
         self.digits = digits
         self.data_path = data_path
@@ -44,15 +175,16 @@ class MNIST_Custom_Noisy(Dataset):
         else:
             self.dataset = datasets.MNIST(root=self.data_path, train=False, transform=None, download=False)
 
-        # Filter dataset to include only specified digits
-        self.indices = [i for i, (image, label) in enumerate(self.dataset) if label in digits]
+        # Filter dataset to include only specified digits (on the label tensor, no image decoding)
+        mask = torch.isin(self.dataset.targets, torch.as_tensor(list(digits), dtype=self.dataset.targets.dtype))
+        self.indices = torch.nonzero(mask).squeeze(1).tolist()
 
     def __len__(self):
         return len(self.indices)
 
     def __getitem__(self, idx):
-        if torch.rand(1) < 0.09:
-            return torch.randn(1, 28, 28), 10
+        if torch.rand(1) < NOISE_PROB:
+            return torch.randn(1, 28, 28), NOISE_LABEL
         idx = self.indices[idx]
         image, label = self.dataset[idx]
 
@@ -75,3 +207,11 @@ class MNIST_Custom_Noisy(Dataset):
 # batch_size = 64
 # train_loader = DataLoader(dataset=custom_train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
 # test_loader = DataLoader(dataset=custom_test_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, default="./dataset", help="Path to MNIST dataset")
+    args = parser.parse_args()
+
+    build_mnist_cache(args.data_path)
+    print("MNIST cache written to ", os.path.join(args.data_path, MNIST_CACHE_FOLDER))
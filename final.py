@@ -16,22 +16,23 @@ import gc
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-import torch.nn as nn
 from torchvision.utils import save_image, make_grid
-from torchvision import datasets, transforms
-import pickle
-from model import OneHotCVAE, loss_function, SelectiveDropout
+from torchvision import transforms
+import json
+from model import OneHotCVAE, CapacityCVAE, loss_function, fused_loss_function, EWCPenalty
 from utils import setup_dirs
 import os
 import argparse
 import logging
 import copy
 import random
-from dataset import MNIST_Custom
+from dataset import MNIST_Custom, get_class_index
 import numpy as np
 from tqdm import tqdm
-from utils import get_config_and_setup_dirs_final, cycle, find_indices_to_drop, prune_model, prune_model_using_dag, expand_model, evaluate_with_classifier
+from utils import get_config_and_setup_dirs_final, cycle_tensors, GenerativeReplayBank, NeuronImportanceTracker, prune_model_using_dag, expand_model, prune_model_, expand_model_, prune_masked_, grow_masked_, export_model, model_from_state_dict, remap_param_dict, evaluate_with_classifier
 from train_sa_vae import train_sa_vae
+from calculate_fim import OnlineFisher
+from tensor_io import save_checkpoint, load_checkpoint, save_fisher_dict, load_fisher_dict, TENSORS_EXTENSION
 
 NUM_TRAIN_EPOCHS = {
     1: 20000,
@@ -50,6 +51,11 @@ BREATHING_PERIOD = 5000
 WARMED_UP = 0
 HYPERPARAMETER_COMPRESS = 0.1
 HYPERPARAMETERS_EXPAND = 0.1
+# running per-class FIM shared by the learn / forget phases, created by the first save_fim
+ONLINE_FISHER = None
+# model and optimizer carried over from one phase to the next with --resize_in_place, set at the end of every phase
+VAE = None
+OPTIMIZER = None
 CLASSIFIER_PATH = ['./classifier_ckpts/model1.pt', './classifier_ckpts/model2.pt', './classifier_ckpts/model3.pt', './classifier_ckpts/model4.pt', './classifier_ckpts/model5.pt'] 
 # CLASSIFIER_PATH = ["/home/stud-1/aditya/vae/classifier_ckpts/model1.pt", "/home/stud-1/aditya/vae/classifier_ckpts/model2.pt", "/home/stud-1/aditya/vae/classifier_ckpts/model3.pt","/home/stud-1/aditya/vae/classifier_ckpts/model4.pt", "/home/stud-1/aditya/vae/classifier_ckpts/model5.pt"]
 METRIC_PATH = {
@@ -98,6 +104,22 @@ def parse_args_and_config():
     parser.add_argument(
         "--n_fim_samples", type=int, default=50, help='Number of samples to visualize while logging'
     )
+
+    parser.add_argument(
+        "--fim_batch_size", type=int, default=1000, help='Number of samples per vectorized per-sample gradient pass of the FIM'
+    )
+
+    parser.add_argument(
+        "--fim_method", type=str, default="vmap", choices=["vmap", "analytic"], help="vmap : vectorized per-sample gradients, analytic : per-layer outer products from hooked activations (lower memory)"
+    )
+
+    parser.add_argument(
+        "--fim_tol", type=float, default=None, help='Stop the FIM estimation once its relative standard error is below this tolerance, n_fim_samples becomes the cap'
+    )
+
+    parser.add_argument(
+        "--fim_decay", type=float, default=1.0, help='Decay applied to the FIM of the earlier classes each time new classes are added (1 keeps them as is)'
+    )
     
     parser.add_argument(
         "--lr", type=float, default=0.0001, help='Learning rate'
@@ -111,9 +133,53 @@ def parse_args_and_config():
         "--gamma", type=float, default=0.0001, help='Learning rate'
     )
 
+    parser.add_argument(
+        "--ewc", type=int, default=0, help='Add the EWC term (lmbda weighted, running FIM) to the continual and forgetting losses'
+    )
+
+    parser.add_argument(
+        "--ewc_grad", type=str, default="autograd", choices=["autograd", "closed_form"], help='Backpropagate the EWC term or add its closed form gradient directly'
+    )
+
+    parser.add_argument(
+        "--expand_mode", type=str, default="perturb", choices=["perturb", "net2net"], help='perturb : new neurons drawn around zero, net2net : new neurons split off existing ones so the expanded model computes the same function'
+    )
+
+    parser.add_argument(
+        "--split_noise", type=float, default=0.0, help='Relative noise on the outgoing weight split of --expand_mode net2net, breaks the symmetry between the copies of a neuron'
+    )
+
+    parser.add_argument(
+        "--resize_in_place", type=int, default=1, help='Prune / expand the live model and its Adam moments between phases instead of rebuilding both from the checkpoint'
+    )
+
+    parser.add_argument(
+        "--capacity_factor", type=float, default=0, help='Allocate the hidden layers at this many times their initial width once and prune / expand by flipping active neuron masks (needs --resize_in_place, 0 reallocates the layers every phase)'
+    )
+
+    parser.add_argument(
+        "--importance_decay", type=float, default=0.9, help='Running average decay of the neuron importance behind the selective dropout refresh (0 rescores the current weights at every refresh)'
+    )
+
+    parser.add_argument(
+        "--importance_update_every", type=int, default=100, help='Steps between two running average updates of the neuron importance (with --importance_decay > 0)'
+    )
+
+    parser.add_argument(
+        "--replay_bank_size", type=int, default=1000, help='Replay samples per remembered label, see utils.GenerativeReplayBank'
+    )
+
+    parser.add_argument(
+        "--replay_refresh", type=int, default=1000, help='Steps between two partial redraws of the replay bank (0 never)'
+    )
+
     parser.add_argument(
         "--input_file", type=str, help='path to the input file'
     )
+
+    parser.add_argument(
+        "--fused_forward", type=int, default=1, help='One forward pass for both loss terms, see model.fused_loss_function'
+    )
     
     parser.add_argument(
         "--user", type=str, default="sid", help='name of the user'
@@ -124,6 +190,13 @@ def parse_args_and_config():
     )
 
     args = parser.parse_args()
+    if args.capacity_factor > 0:
+        if not args.resize_in_place:
+            parser.error("--capacity_factor keeps the model across the phases, it needs --resize_in_place 1")
+        if args.expand_mode != "perturb":
+            parser.error("--capacity_factor grows neurons with --expand_mode perturb only")
+        if args.fim_method == "analytic":
+            parser.error("--fim_method analytic hooks the Linear modules, which the --capacity_factor model does not call")
     config = get_config_and_setup_dirs_final(args.config)
 
     handler1 = logging.StreamHandler()
@@ -140,45 +213,33 @@ def parse_args_and_config():
     
     return args, config
 
-def save_fim(vae, device, args, config):
-    vae.train()
-    fisher_dict = {}
-    params_mle_dict = {}
-    
-    for name, param in vae.named_parameters():
-        params_mle_dict[name] = param.data.clone()
-        fisher_dict[name] = param.data.clone().zero_()
-    
-    for _ in tqdm(range(args.n_fim_samples)):
-        
-        with torch.no_grad():
-            z = torch.randn(1, config.z_dim).to(device)
-            c = torch.randint(0,10, (1,)).to(device)
-            c = F.one_hot(c, 10)
-            vae.eval()
-            sample = vae.decoder(z, c)
-        
-        vae.train()
-        vae.zero_grad()
-        recon_batch, mu, log_var = vae(sample, c)
-        loss = loss_function(recon_batch, sample, mu, log_var)
-        loss.backward()
-
-        for name, param in vae.named_parameters():
-            if torch.isnan(param.grad.data).any():
-                print("NAN detected")
-            fisher_dict[name] += ((param.grad.data) ** 2) / args.n_fim_samples
+def save_fim(vae, device, args, config, labels_to_add=(), labels_to_remove=()):
+    # phase-aware update of the running FIM (see calculate_fim.OnlineFisher) : the classes of labels_to_remove are subtracted,
+    # only labels_to_add are estimated, and fisher_dict.tensors then holds the estimate over the currently learnt classes
+    global ONLINE_FISHER
+    if ONLINE_FISHER is None:
+        ONLINE_FISHER = OnlineFisher(decay=args.fim_decay)
+    ONLINE_FISHER.remove_classes(labels_to_remove)
+    # same number of samples per class as the uniform draw over the 10 digits
+    n_samples_per_class = max(1, args.n_fim_samples // 10)
+    ONLINE_FISHER.update(vae, config, device, labels_to_add, n_samples_per_class, args.fim_batch_size, method=args.fim_method, tol=args.fim_tol)
+    fisher_dict = ONLINE_FISHER.fisher()
         
-    with open(os.path.join(config.exp_root_dir, 'fisher_dict.pkl'), 'wb') as f:
-        pickle.dump(fisher_dict, f)
+    save_fisher_dict(config.exp_root_dir, fisher_dict)
+    # per-class sample counts and relative standard errors of the estimate
+    with open(os.path.join(config.exp_root_dir, 'fisher_info.json'), 'w') as f:
+        json.dump(dict(ONLINE_FISHER.info(), tol=args.fim_tol, max_samples_per_class=n_samples_per_class), f, indent=4)
 
 def train_initial(LEARNT_LABELS, labels_to_learn, optimizer_name, n_iter, device, args, config, line_count):
+    global VAE, OPTIMIZER
     LEARNT_LABELS.extend(labels_to_learn)
     print("learnt labels : ", LEARNT_LABELS)
-    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
-    train_iter = cycle(train_loader)
-    vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim)
+    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
+    train_iter = cycle_tensors(train_dataset.data, train_dataset.targets, args.batch_size, device)
+    if args.capacity_factor > 0:
+        vae = CapacityCVAE(x_dim=config.x_dim, h_dim1=config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim, max_h_dim1=int(config.h_dim1 * args.capacity_factor), max_h_dim2=int(config.h_dim2 * args.capacity_factor))
+    else:
+        vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim)
     vae = vae.to(device)
 
     if optimizer_name == 'adam':
@@ -189,7 +250,6 @@ def train_initial(LEARNT_LABELS, labels_to_learn, optimizer_name, n_iter, device
     train_loss = 0
     for step in tqdm(range(0, n_iter)):
         data, label = next(train_iter)
-        label = F.one_hot(label, 10)
         data = data.to(device)
         label = label.to(device)
         optimizer.zero_grad()
@@ -208,26 +268,26 @@ def train_initial(LEARNT_LABELS, labels_to_learn, optimizer_name, n_iter, device
             train_loss = 0
     
     
-    # save the model
-    state_dict_to_save = vae.state_dict()
-    torch.save({
-            "model": state_dict_to_save,
-            "config": config,
-            "labels": labels_to_learn,
-            "fisher_dict": None, # TODO: save fisher dict
-            "params_mle_dict": None, # TODO: save params_mle_dict
-            "h_dims1": state_dict_to_save['fc1.weight'].shape[0], #TODO:
-            "h_dims2": state_dict_to_save['fc2.weight'].shape[0], #TODO:
-        },
-        os.path.join(config.ckpt_dir, "ckpt_modified.pt"))
+    # save the model (only its active neurons for a CapacityCVAE)
+    state_dict_to_save, _ = export_model(vae)
+    save_checkpoint(
+        os.path.join(config.ckpt_dir, "ckpt_modified" + TENSORS_EXTENSION),
+        state_dict_to_save,
+        config,
+        {"fisher_dict": None, "params_mle_dict": None},
+        labels=labels_to_learn,
+        h_dims1=state_dict_to_save['fc1.weight'].shape[0],
+        h_dims2=state_dict_to_save['fc2.weight'].shape[0],
+    )
     
     cum_sum, avg_entropy = evaluate_with_classifier(config.ckpt_dir, CLASSIFIER_PATH, LEARNT_LABELS, [], METRIC_PATH, config)
-    save_fim(vae, device, args, config)
+    save_fim(vae, device, args, config, labels_to_add=labels_to_learn)
+    VAE, OPTIMIZER = vae, optimizer
 
     return LEARNT_LABELS
 
 def train_continual(labels_to_learn, optimizer_name, n_iter, vae, device, args, config, line_count):
-    global WARMED_UP, BREATHING_PERIOD, WARMUP_PERIOD, HYPERPARAMETERS_EXPAND, LEARNT_LABELS
+    global WARMED_UP, BREATHING_PERIOD, WARMUP_PERIOD, HYPERPARAMETERS_EXPAND, LEARNT_LABELS, VAE, OPTIMIZER
     # take union of learnt labels and new labels
     labels_to_remember = LEARNT_LABELS.copy()
     size_before = len(LEARNT_LABELS)
@@ -235,28 +295,41 @@ def train_continual(labels_to_learn, optimizer_name, n_iter, vae, device, args,
     print("learnt labels : ", LEARNT_LABELS)
     size_now = len(LEARNT_LABELS)
 
-    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
-    train_iter = cycle(train_loader)
+    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
+    train_iter = cycle_tensors(train_dataset.data, train_dataset.targets, args.batch_size, device)
 
     vae_clone = copy.deepcopy(vae)
     vae_clone.eval()
+    replay = GenerativeReplayBank(vae_clone, labels_to_remember, config.z_dim, args.replay_bank_size, device, refresh_every=args.replay_refresh)
     
     # expand the model :
     print("EXPANDING MODEL")
-    h_dim1 =int(vae.state_dict()['fc1.weight'].shape[0] * HYPERPARAMETERS_EXPAND) + vae.state_dict()['fc1.weight'].shape[0]
-    h_dim2 = int(vae.state_dict()['fc2.weight'].shape[0] * HYPERPARAMETERS_EXPAND) + vae.state_dict()['fc2.weight'].shape[0]
-    
     print("before expanding the model")
-    for layer_name in vae.state_dict():
-        print(f"Layer {layer_name} shape: {vae.state_dict()[layer_name].shape}")
+    for layer_name, param in vae.named_parameters():
+        print(f"Layer {layer_name} shape: {param.shape}")
         
-    state_dict_expanded = expand_model(vae.state_dict(), HYPERPARAMETERS_EXPAND)
-    vae = OneHotCVAE(x_dim=config.x_dim, h_dim1=h_dim1, h_dim2=h_dim2, z_dim=config.z_dim)
-    vae.load_state_dict(state_dict_expanded)
-    vae = vae.to(device)
-    if optimizer_name == 'adam':
-        optimizer = optim.Adam(vae.parameters(), lr=args.lr)
+    if isinstance(vae, CapacityCVAE):
+        # activates free slots, the shapes do not change so there is nothing to remap
+        optimizer = OPTIMIZER
+        grow_masked_(vae, HYPERPARAMETERS_EXPAND, optimizer=optimizer)
+        index_maps = {}
+    elif args.resize_in_place and OPTIMIZER is not None:
+        # grows the live parameters and the Adam moments with them, the new neurons start with zero moments
+        optimizer = OPTIMIZER
+        index_maps = expand_model_(vae, HYPERPARAMETERS_EXPAND, optimizer=optimizer, mode=args.expand_mode, split_noise=args.split_noise)
+    else:
+        state_dict_expanded, index_maps = expand_model(vae.state_dict(), HYPERPARAMETERS_EXPAND, return_index_maps=True, model=vae, mode=args.expand_mode, split_noise=args.split_noise)
+        vae = model_from_state_dict(state_dict_expanded).to(device)
+        if optimizer_name == 'adam':
+            optimizer = optim.Adam(vae.parameters(), lr=args.lr)
+    # carry the running FIM over to the expanded shapes instead of re-estimating the classes already learnt
+    if ONLINE_FISHER is not None:
+        ONLINE_FISHER.remap(index_maps)
+    # anchored at the expanded parameters, the new neurons have zero importance and stay free
+    ewc = None
+    if args.ewc and ONLINE_FISHER is not None:
+        ewc = EWCPenalty(vae, ONLINE_FISHER.fisher(), {name: param.detach().clone() for name, param in vae.named_parameters()})
+    importance = NeuronImportanceTracker(vae, decay=args.importance_decay, update_every=args.importance_update_every)
     vae.train()
     train_loss = 0
     learning_loss = 0
@@ -264,58 +337,42 @@ def train_continual(labels_to_learn, optimizer_name, n_iter, vae, device, args,
     for step in tqdm(range(0, n_iter)):
         if step >= WARMUP_PERIOD:
             WARMED_UP = 1
-        c_remember = torch.from_numpy(np.random.choice(labels_to_remember, size=args.batch_size)).to(device)
-        c_remember = F.one_hot(c_remember, 10)
-        z_remember = torch.randn((args.batch_size, config.z_dim)).to(device)
+        out_remember, c_remember = replay.sample(args.batch_size)
 
         out_new, c_new = next(train_iter)
-        c_new = F.one_hot(c_new, 10)
         out_new = out_new.to(device)
         c_new = c_new.to(device)
-
-        with torch.no_grad():
-            out_remember = vae_clone.decoder(z_remember, c_remember)
         
         optimizer.zero_grad()
 
-        #learning_loss
-        recon_batch, mu, log_var = vae(out_remember, c_remember)
-        loss = loss_function(recon_batch, out_remember, mu, log_var)
+        if args.fused_forward:
+            loss_remember, loss_new = fused_loss_function(vae, out_remember, c_remember, out_new, c_new)
+            loss = loss_remember + loss_new
+        else:
+            #learning_loss
+            recon_batch, mu, log_var = vae(out_remember, c_remember)
+            loss = loss_function(recon_batch, out_remember, mu, log_var)
 
-        #contrastive loss
-        recon_batch, mu, log_var = vae(out_new, c_new)
-        loss += loss_function(recon_batch, out_new, mu, log_var)
+            #contrastive loss
+            recon_batch, mu, log_var = vae(out_new, c_new)
+            loss += loss_function(recon_batch, out_new, mu, log_var)
 
         learning_loss += loss / args.log_freq
 
-        # for n, p in vae.named_parameters():
-        #     _loss = fisher_dict[n].to(device) * (p - params_mle_dict[n].to(device)) ** 2
-        #     loss += args.lmbda * _loss.sum()
-        #     ewc_loss += args.lmbda * _loss.sum() / args.log_freq
-        loss.backward()
+        if ewc is not None:
+            loss, penalty = ewc.backward(loss, args.lmbda, closed_form=args.ewc_grad == "closed_form")
+            ewc_loss += args.lmbda * penalty / args.log_freq
+        else:
+            loss.backward()
         train_loss += loss.item() / args.log_freq
         optimizer.step()
+        importance.step()
 
         # ADDING SELECTIVE DROPOUT
         if WARMED_UP and step % BREATHING_PERIOD == 0:
             # print("Warned up and ready")
-            for layer_name, _ in vae.named_parameters():
-                if 'fc' in layer_name and 'weight' in layer_name:
-                    attribute_name = layer_name.split('.')[0]
-                    base_layer_name = layer_name.rsplit('.', 1)[0]
-                    indices = find_indices_to_drop(vae.state_dict(), base_layer_name)
-                    current_layer = getattr(vae, attribute_name)
-                    
-                    if isinstance(current_layer, nn.Sequential) and any(isinstance(layer, SelectiveDropout) for layer in current_layer):
-                        # If the layer is already a nn.Sequential with a SelectiveDropout, update the dropout layer
-                        for i, layer in enumerate(current_layer):
-                            if isinstance(layer, SelectiveDropout):
-                                current_layer[i] = SelectiveDropout(dropout_rate=0.5, neuron_indices=indices)
-                    else:
-                        # If it's not modified yet, add the dropout layer
-                        dropout_layer = SelectiveDropout(dropout_rate=0.5, neuron_indices=indices)
-                        modified_layer = nn.Sequential(current_layer, dropout_layer)
-                        setattr(vae, attribute_name, modified_layer)
+            for layer_name in importance.layers:
+                vae.set_selective_dropout(layer_name, importance.bottom_k(layer_name), dropout_rate=0.5)
 
         if (step+1) % args.log_freq == 0:
             logging.info('Train Step: {} ({:.0f}%)\t Avg Train Loss Per Batch: {:.6f}'.format(
@@ -331,36 +388,32 @@ def train_continual(labels_to_learn, optimizer_name, n_iter, vae, device, args,
     
     # save the model
     # state_dict_to_save = prune_model_using_dag(vae.state_dict())
-    model_state_dict = vae.state_dict()
-    for key in list(model_state_dict.keys()):
-        if '.0.' in key:
-            new_key = key.replace('.0.', '.')
-            model_state_dict[new_key] = model_state_dict.pop(key)
-    state_dict_to_save = model_state_dict
+    state_dict_to_save, _ = export_model(vae)
     # print("state_dict_to_save : ", state_dict_to_save.keys())
-    torch.save({
-            "model": state_dict_to_save,
-            "config": config,
-            "labels": LEARNT_LABELS,
-            "fisher_dict": None, # TODO: save fisher dict
-            "params_mle_dict": None, # TODO: save params_mle_dict
-            "h_dims1": state_dict_to_save['fc1.weight'].shape[0], #TODO:
-            "h_dims2": state_dict_to_save['fc2.weight'].shape[0], #TODO:
-        },
-        os.path.join(config.ckpt_dir, "ckpt_modified.pt"))
+    save_checkpoint(
+        os.path.join(config.ckpt_dir, "ckpt_modified" + TENSORS_EXTENSION),
+        state_dict_to_save,
+        config,
+        {"fisher_dict": None, "params_mle_dict": None},
+        labels=LEARNT_LABELS,
+        h_dims1=state_dict_to_save['fc1.weight'].shape[0],
+        h_dims2=state_dict_to_save['fc2.weight'].shape[0],
+    )
 
     cum_sum, avg_entropy = evaluate_with_classifier(config.ckpt_dir, CLASSIFIER_PATH, LEARNT_LABELS, [], METRIC_PATH, config)
-    save_fim(vae, device, args, config)
+    save_fim(vae, device, args, config, labels_to_add=labels_to_learn)
     WARMED_UP = 0
+    VAE, OPTIMIZER = vae, optimizer
     return LEARNT_LABELS
 
 def train_forget(labels_to_forget, optimizer_name, n_iter, vae, device, args, config, line_count):
-    global WARMED_UP, BREATHING_PERIOD, WARMUP_PERIOD, LEARNT_LABELS
+    global WARMED_UP, BREATHING_PERIOD, WARMUP_PERIOD, LEARNT_LABELS, VAE, OPTIMIZER
     vae_clone = copy.deepcopy(vae)
     vae_clone.eval()
 
     LEARNT_LABELS = [i for i in LEARNT_LABELS if i not in labels_to_forget]
     print("learnt labels : ", LEARNT_LABELS)
+    replay = GenerativeReplayBank(vae_clone, LEARNT_LABELS, config.z_dim, args.replay_bank_size, device, refresh_every=args.replay_refresh)
 
     # train_dataset = MNIST_Custom(digits=LEARNT_LABELS, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
     # train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
@@ -370,19 +423,33 @@ def train_forget(labels_to_forget, optimizer_name, n_iter, vae, device, args, co
     for name, param in vae.named_parameters():
         params_mle_dict[name] = param.data.clone()
     
-    with open(os.path.join(config.exp_root_dir, 'fisher_dict.pkl'), 'rb') as f:
-        fisher_dict = pickle.load(f)
+    fisher_dict = load_fisher_dict(config.exp_root_dir, device=device)
 
     print("before compression:")
-    for layer_name in vae.state_dict():
-        print(f"Layer {layer_name} shape: {vae.state_dict()[layer_name].shape}")
-
-    state_dict_pruned = prune_model_using_dag(vae.state_dict(), type=2)
-    vae = OneHotCVAE(x_dim=config.x_dim, h_dim1=state_dict_pruned['fc1.weight'].shape[0], h_dim2=state_dict_pruned['fc2.weight'].shape[0], z_dim=config.z_dim)
-    vae.load_state_dict(state_dict_pruned)
-    vae = vae.to(device)
-    if optimizer_name == 'adam':
-        optimizer = optim.Adam(vae.parameters(), lr=args.lr)
+    for layer_name, param in vae.named_parameters():
+        print(f"Layer {layer_name} shape: {param.shape}")
+
+    if isinstance(vae, CapacityCVAE):
+        # masks the dropped neurons out, the shapes do not change so there is nothing to remap
+        optimizer = OPTIMIZER
+        prune_masked_(vae, optimizer=optimizer)
+        index_maps = {}
+    elif args.resize_in_place and OPTIMIZER is not None:
+        # slices the live parameters and the Adam moments of the dropped neurons
+        optimizer = OPTIMIZER
+        index_maps = prune_model_(vae, optimizer=optimizer)
+    else:
+        state_dict_pruned, index_maps = prune_model_using_dag(vae.state_dict(), type=2, return_index_maps=True, model=vae)
+        vae = model_from_state_dict(state_dict_pruned).to(device)
+        if optimizer_name == 'adam':
+            optimizer = optim.Adam(vae.parameters(), lr=args.lr)
+    # slice the Fisher and MLE parameters of the dropped neurons so they keep matching the pruned parameters
+    fisher_dict = remap_param_dict(fisher_dict, index_maps)
+    params_mle_dict = remap_param_dict(params_mle_dict, index_maps, fill_dict={name: param.detach() for name, param in vae.named_parameters()})
+    if ONLINE_FISHER is not None:
+        ONLINE_FISHER.remap(index_maps)
+    ewc = EWCPenalty(vae, fisher_dict, params_mle_dict) if args.ewc else None
+    importance = NeuronImportanceTracker(vae, decay=args.importance_decay, update_every=args.importance_update_every)
     vae.train()
     train_loss = 0
     forgetting_loss = 0
@@ -391,58 +458,41 @@ def train_forget(labels_to_forget, optimizer_name, n_iter, vae, device, args, co
     for step in tqdm(range(0, n_iter)):
         if step >= WARMUP_PERIOD:
             WARMED_UP = 1
-        c_remember = torch.from_numpy(np.random.choice(LEARNT_LABELS, size=args.batch_size)).to(device)
-        c_remember = F.one_hot(c_remember, 10)
-        z_remember = torch.randn((args.batch_size, config.z_dim)).to(device)
+        out_remember, c_remember = replay.sample(args.batch_size)
 
         c_forget = torch.from_numpy(np.random.choice(labels_to_forget, size=args.batch_size)).to(device)
-        c_forget = F.one_hot(c_forget, 10)
         out_forget = torch.rand((args.batch_size, 1, 28, 28)).to(device)
-
-        with torch.no_grad():
-            out_remember = vae_clone.decoder(z_remember, c_remember).view(-1, 1, 28, 28)
         
         optimizer.zero_grad()
 
-        #corrupting loss
-        recon_batch, mu, log_var = vae(out_forget, c_forget)
-        loss = loss_function(recon_batch, out_forget, mu, log_var)
+        if args.fused_forward:
+            loss_forget, loss_remember = fused_loss_function(vae, out_forget, c_forget, out_remember, c_remember)
+            loss = loss_forget + args.gamma * loss_remember
+        else:
+            #corrupting loss
+            recon_batch, mu, log_var = vae(out_forget, c_forget)
+            loss = loss_function(recon_batch, out_forget, mu, log_var)
 
-        #contrastive loss
-        recon_batch, mu, log_var = vae(out_remember, c_remember)
-        loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
+            #contrastive loss
+            recon_batch, mu, log_var = vae(out_remember, c_remember)
+            loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
 
         forgetting_loss += loss / args.log_freq
 
-        # for n, p in vae.named_parameters():
-        #     _loss = fisher_dict[n].to(device) * (p - params_mle_dict[n].to(device)) ** 2
-        #     loss += args.lmbda * _loss.sum()
-        #     ewc_loss += args.lmbda * _loss.sum() / args.log_freq
-        
-        loss.backward()
+        if ewc is not None:
+            loss, penalty = ewc.backward(loss, args.lmbda, closed_form=args.ewc_grad == "closed_form")
+            ewc_loss += args.lmbda * penalty / args.log_freq
+        else:
+            loss.backward()
         train_loss += loss.item() / args.log_freq
         optimizer.step()
+        importance.step()
 
         # ADDING SELECTIVE DROPOUT
         if WARMED_UP and step % BREATHING_PERIOD == 0:
             # print("Warned up and ready")
-            for layer_name, _ in vae.named_parameters():
-                if 'fc' in layer_name and 'weight' in layer_name:
-                    attribute_name = layer_name.split('.')[0]
-                    base_layer_name = layer_name.rsplit('.', 1)[0]
-                    indices = find_indices_to_drop(vae.state_dict(), base_layer_name)
-                    current_layer = getattr(vae, attribute_name)
-                    
-                    if isinstance(current_layer, nn.Sequential) and any(isinstance(layer, SelectiveDropout) for layer in current_layer):
-                        # If the layer is already a nn.Sequential with a SelectiveDropout, update the dropout layer
-                        for i, layer in enumerate(current_layer):
-                            if isinstance(layer, SelectiveDropout):
-                                current_layer[i] = SelectiveDropout(dropout_rate=0.5, neuron_indices=indices)
-                    else:
-                        # If it's not modified yet, add the dropout layer
-                        dropout_layer = SelectiveDropout(dropout_rate=0.5, neuron_indices=indices)
-                        modified_layer = nn.Sequential(current_layer, dropout_layer)
-                        setattr(vae, attribute_name, modified_layer)
+            for layer_name in importance.layers:
+                vae.set_selective_dropout(layer_name, importance.bottom_k(layer_name), dropout_rate=0.5)
 
         if (step+1) % args.log_freq == 0:
             logging.info('Train Step: {} ({:.0f}%)\t Avg Train Loss Per Batch: {:.6f}'.format(
@@ -457,38 +507,32 @@ def train_forget(labels_to_forget, optimizer_name, n_iter, vae, device, args, co
             ewc_loss = 0
     
     # state_dict_to_save = prune_model_using_dag(vae.state_dict())
-    state_dict_to_save = vae.state_dict()
-    # remove .0. from the keys
-    for key in list(state_dict_to_save.keys()):
-        if '.0.' in key:
-            new_key = key.replace('.0.', '.')
-            state_dict_to_save[new_key] = state_dict_to_save.pop(key)
+    state_dict_to_save, export_maps = export_model(vae)
     #save the model
-    torch.save({
-            "model": state_dict_to_save,
-            "config": config,
-            "labels": LEARNT_LABELS,
-            "fisher_dict": fisher_dict, # TODO: save fisher dict
-            "params_mle_dict": params_mle_dict, # TODO: save params_mle_dict
-            "h_dims1": state_dict_to_save['fc1.weight'].shape[0], #TODO
-            "h_dims2": state_dict_to_save['fc2.weight'].shape[0], #TODO
-        },
-        os.path.join(config.ckpt_dir, "ckpt_modified.pt"))
+    save_checkpoint(
+        os.path.join(config.ckpt_dir, "ckpt_modified" + TENSORS_EXTENSION),
+        state_dict_to_save,
+        config,
+        {"fisher_dict": remap_param_dict(fisher_dict, export_maps), "params_mle_dict": remap_param_dict(params_mle_dict, export_maps)},
+        labels=LEARNT_LABELS,
+        h_dims1=state_dict_to_save['fc1.weight'].shape[0],
+        h_dims2=state_dict_to_save['fc2.weight'].shape[0],
+    )
 
     cum_sum, avg_entropy = evaluate_with_classifier(config.ckpt_dir, CLASSIFIER_PATH, LEARNT_LABELS, labels_to_forget, METRIC_PATH, config)
-    save_fim(vae, device, args, config)
+    save_fim(vae, device, args, config, labels_to_remove=labels_to_forget)
+    VAE, OPTIMIZER = vae, optimizer
 
     return LEARNT_LABELS
 
 def test(labels_to_learn, vae, device, args):
-    test_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=False, transform=transforms.ToTensor(), download=False)
+    test_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=False, transform=transforms.ToTensor(), download=False, in_memory=True)
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False)
 
     vae.eval()
     test_loss= 0
     with torch.no_grad():
         for data, label in test_loader:
-            label = F.one_hot(label, 10)
             data = data.to(device)
             label = label.to(device)
             recon, mu, log_var = vae(data, label)
@@ -562,6 +606,9 @@ def main():
         lines = file.readlines()
         # n_lines = len(lines)
 
+    # build the per-class train / test index once, every learn / forget phase and test() call resolves its labels through it
+    get_class_index(args.data_path)
+
     # initial training
     initial_labels = random.sample(range(10), random.randint(1, 10))
     optimizer_name = 'adam'
@@ -594,13 +641,15 @@ def main():
             n_iter = NUM_TRAIN_EPOCHS[len(labels_to_learn)]
         
         optimizer_name = 'adam'
-        # load the vae
-        checkpoint = torch.load(os.path.join(config.ckpt_dir, "ckpt_modified.pt"))
-        h_dim1 = checkpoint['h_dims1']
-        h_dim2 = checkpoint['h_dims2']
-        vae = OneHotCVAE(x_dim=config.x_dim, h_dim1=h_dim1, h_dim2=h_dim2, z_dim=config.z_dim)
-        vae.load_state_dict(checkpoint['model'])
-        vae = vae.to(device)
+        if args.resize_in_place and VAE is not None:
+            # continue from the live model, like the reloaded one it starts the phase without selective dropout
+            vae = VAE
+            vae.selective_dropout.clear()
+        else:
+            # load the vae
+            checkpoint = load_checkpoint(os.path.join(config.ckpt_dir, "ckpt_modified"), groups=(), device=device)
+            # every layer sized from its own weight, the encoder and decoder widths are not tied after pruning / expanding
+            vae = model_from_state_dict(checkpoint['model']).to(device)
         
         if action == 0:
             LEARNT_LABELS = train_forget(labels_to_forget, optimizer_name, n_iter, vae, device, args, config, n_passes_completed)
@@ -1,6 +1,8 @@
 import torch
 import tqdm
 from model import OneHotCVAE
+from tensor_io import load_checkpoint
+from utils import DECODER_PARAMS
 import torch.nn.functional as F
 import os
 import argparse
@@ -35,14 +37,14 @@ if __name__ == "__main__":
     
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     args = parse_args()
-    ckpt = torch.load(os.path.join(args.ckpt_folder, "ckpts/ckpt.pt"), map_location=device)
+    ckpt = load_checkpoint(os.path.join(args.ckpt_folder, "ckpts/ckpt"), names=DECODER_PARAMS, groups=(), device=device)
     config = ckpt['config']
     
     # build model
     vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim)
     vae = vae.to(device)
     
-    vae.load_state_dict(ckpt['model'])
+    vae.load_state_dict(ckpt['model'], strict=False)
     vae.eval()
     
     sample_dir = os.path.join(args.ckpt_folder, f"{args.label_to_generate}_samples")
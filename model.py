@@ -16,28 +16,61 @@ class OneHotCVAE(nn.Module):
         self.fc4 = nn.Linear(z_dim + class_size, h_dim2)
         self.fc5 = nn.Linear(h_dim2, h_dim1)
         self.fc6 = nn.Linear(h_dim1, x_dim)
+        # optional SelectiveDropout on the output of fc layers, keyed by layer name (see set_selective_dropout)
+        # its buffers are not persistent, so the state_dict keys stay fc1.weight, fc1.bias, ...
+        self.selective_dropout = nn.ModuleDict()
+        # row counts of the batches concatenated into the current forward pass (see fused_loss_function), each one gets
+        # its own selective dropout draw as if it went through its own forward pass, None for a single batch
+        self.dropout_segments = None
+
+    def set_selective_dropout(self, layer_name, neuron_indices, dropout_rate=0.5):
+        # attaches a SelectiveDropout to the output of layer_name, or refreshes the indices of the existing one in place
+        if layer_name in self.selective_dropout:
+            self.selective_dropout[layer_name].dropout_rate = dropout_rate
+            self.selective_dropout[layer_name].set_indices(neuron_indices)
+        else:
+            layer = getattr(self, layer_name)
+            dropout_layer = SelectiveDropout(dropout_rate, neuron_indices, layer.out_features, device=layer.weight.device)
+            self.selective_dropout[layer_name] = dropout_layer
+
+    def _dropout(self, layer_name, h):
+        if layer_name in self.selective_dropout:
+            return self.selective_dropout[layer_name](h, self.dropout_segments)
+        return h
+
+    def _conditioned_linear(self, layer, inputs, c):
+        # c is either one-hot (B, class_size) and concatenated onto the input as before,
+        # or integer labels (B,) : then the matching class column of the weight is gathered and added as a bias,
+        # which gives the same result without building the (B, in + class_size) input
+        # (the layer module itself is not called in that case, so its hooks do not fire)
+        if c.dim() == 1:
+            n_in = inputs.shape[1]
+            return F.linear(inputs, layer.weight[:, :n_in], layer.bias) + layer.weight[:, n_in:].t()[c]
+        return layer(torch.cat([inputs, c], dim=1))
         
     def encoder(self, x, c):
-        inputs = torch.cat([x,c], dim=1)
-        h = F.relu(self.fc1(inputs))
-        h = F.relu(self.fc2(h))
-        return self.fc31(h), self.fc32(h) # mu, log_var
+        h = F.relu(self._dropout('fc1', self._conditioned_linear(self.fc1, x, c)))
+        h = F.relu(self._dropout('fc2', self.fc2(h)))
+        return self._dropout('fc31', self.fc31(h)), self._dropout('fc32', self.fc32(h)) # mu, log_var
     
     def sampling(self, mu, log_var):
         std = torch.exp(0.5*log_var)
         eps = torch.randn_like(std)
         return eps.mul(std).add_(mu) # return z sample
         
-    def decoder(self, z, c):
-        inputs = torch.cat([z,c], dim=1)
-        h = F.relu(self.fc4(inputs))
-        h = F.relu(self.fc5(h))
-        return torch.sigmoid(self.fc6(h)) 
+    def decoder(self, z, c, logits=False):
+        # logits=True skips the final sigmoid, for loss_function(..., logits=True)
+        h = F.relu(self._dropout('fc4', self._conditioned_linear(self.fc4, z, c)))
+        h = F.relu(self._dropout('fc5', self.fc5(h)))
+        out = self._dropout('fc6', self.fc6(h))
+        if logits:
+            return out
+        return torch.sigmoid(out) 
     
-    def forward(self, x, c):
+    def forward(self, x, c, logits=False):
         mu, log_var = self.encoder(x.view(-1, 784), c)
         z = self.sampling(mu, log_var)
-        return self.decoder(z, c), mu, log_var
+        return self.decoder(z, c, logits=logits), mu, log_var
     
 
 class Classifier(nn.Module):
@@ -61,38 +94,328 @@ class Classifier(nn.Module):
         return F.log_softmax(x, dim=1)
     
 class SelectiveDropout(nn.Module):
-    def __init__(self, dropout_rate, neuron_indices):
+    def __init__(self, dropout_rate, neuron_indices, num_features, device=None):
         super(SelectiveDropout, self).__init__()
         self.dropout_rate = dropout_rate
-        self.neuron_indices = neuron_indices
-
-    def forward(self, inputs):
-        if self.training and len(self.neuron_indices) != 0 and self.dropout_rate != 0:
-            # print("inside training mode ")
-            # print("inputs ", inputs)
-            mask = torch.ones_like(inputs, dtype=torch.float32).to(inputs.device)
-            neuron_indices = torch.ones(inputs.shape[1], dtype=torch.float32).to(inputs.device)
-            # make the neuron_indices at positions self.neuron_indices to 0 with probability self.dropout_rate
-            for i in self.neuron_indices:
-                # set neuron_indices[i] to 0 with probability self.dropout_rate
-                if torch.rand(1) < self.dropout_rate:
-                    neuron_indices[i] = 0
-                else :
-                    neuron_indices[i] = 1 * 1/(1 - self.dropout_rate)
-            # multiply the mask which is an array of arrays with the neuron_indices
-            # print("neuron_indices ", neuron_indices)
-            mask = mask * neuron_indices
-            # print("mask ", mask)
-            # print("returning ", inputs * mask)
+        # per-feature flag of the neurons that may be dropped, not saved in the state_dict
+        self.register_buffer('neuron_mask', torch.zeros(num_features, dtype=torch.bool, device=device), persistent=False)
+        self.set_indices(neuron_indices)
+
+    @property
+    def neuron_indices(self):
+        return torch.nonzero(self.neuron_mask).squeeze(1)
+
+    def set_indices(self, neuron_indices):
+        # updates the buffer in place, the module (and whatever holds it) stays the same
+        neuron_indices = torch.as_tensor(neuron_indices, dtype=torch.long, device=self.neuron_mask.device)
+        self.neuron_mask.zero_()
+        self.neuron_mask[neuron_indices] = True
+        self.n_selected = neuron_indices.numel()
+
+    def forward(self, inputs, segments=None):
+        if self.training and self.n_selected != 0 and self.dropout_rate != 0:
+            # one keep / drop draw per feature, broadcast over the batch, or over each of the segments (row counts) of it
+            # selected neurons are dropped with probability dropout_rate and rescaled by 1/(1 - dropout_rate) otherwise
+            # inputs may only cover the leading features (active slice of a CapacityCVAE layer)
+            n_features = inputs.shape[-1]
+            n_draws = 1 if segments is None else len(segments)
+            keep = torch.rand((n_draws, n_features), device=inputs.device) >= self.dropout_rate
+            scale = keep.to(inputs.dtype) / (1 - self.dropout_rate)
+            mask = torch.where(self.neuron_mask[:n_features], scale, torch.ones_like(scale))
+            if segments is not None:
+                mask = mask.repeat_interleave(torch.as_tensor(segments, device=inputs.device), dim=0, output_size=inputs.shape[0])
             return inputs * mask
         else:
             return inputs
 
-def loss_function(recon_x, x, mu, log_var):
-    BCE = F.binary_cross_entropy(recon_x, x.view(-1, 784), reduction='sum')
-    KLD = -0.5 * torch.sum(1 + log_var - mu.pow(2) - log_var.exp())
+def _set_submodule(model, name, module):
+    parent_name, _, attribute_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name) if parent_name else model, attribute_name, module)
+
+def fit_linear_shapes_(model, model_state_dict):
+    # replaces every nn.Linear of model whose shape differs from its weight in model_state_dict by a fresh one of that
+    # shape, so that load_state_dict works whatever widths the layers were pruned / expanded to (missing layers are kept)
+    for name, module in list(model.named_modules()):
+        if not isinstance(module, nn.Linear) or name + '.weight' not in model_state_dict:
+            continue
+        out_features, in_features = model_state_dict[name + '.weight'].shape
+        if (out_features, in_features) != (module.out_features, module.in_features):
+            _set_submodule(model, name, nn.Linear(in_features, out_features, bias=module.bias is not None, device=module.weight.device, dtype=module.weight.dtype))
+    return model
+
+def normalize_keys(model_state_dict):
+    # the old wrapped layers saved their parameters as fc1.0.weight, ...
+    return {key.replace('.0.', '.'): value for key, value in model_state_dict.items()}
+
+def model_from_state_dict(model_state_dict):
+    # OneHotCVAE holding model_state_dict, every layer sized from its own weight
+    model_state_dict = normalize_keys(model_state_dict)
+    x_dim = model_state_dict['fc6.weight'].shape[0]
+    vae = OneHotCVAE(
+        x_dim=x_dim,
+        h_dim1=model_state_dict['fc1.weight'].shape[0],
+        h_dim2=model_state_dict['fc2.weight'].shape[0],
+        z_dim=model_state_dict['fc31.weight'].shape[0],
+        class_size=model_state_dict['fc1.weight'].shape[1] - x_dim,
+    )
+    fit_linear_shapes_(vae, model_state_dict)
+    vae.load_state_dict(model_state_dict)
+    return vae.to(model_state_dict['fc1.weight'].device)
+
+class CapacityCVAE(OneHotCVAE):
+    # OneHotCVAE allocated once at its maximum widths (max_h_dim1 / max_h_dim2) with an active neuron mask per hidden layer :
+    # pruning and growing flip mask entries (prune_neurons_ / grow_neurons_) instead of reallocating the parameters,
+    # the forward pass only multiplies the slice of every weight up to the last active neuron and zeroes the inactive ones
+    # (so they get no gradient), compact() exports the active neurons as a plain OneHotCVAE
+    # the consumer columns of inactive neurons are kept at zero, so importance scores over full weight rows only see active inputs
+    # the Linear modules themselves are not called, so their hooks do not fire : utils.trace_linear_graph and the analytic / K-FAC FIM raise ValueError on it
+    # consumers of the output of every hidden layer
+    CONSUMERS = {'fc1': ['fc2'], 'fc2': ['fc31', 'fc32'], 'fc4': ['fc5'], 'fc5': ['fc6']}
+    PRODUCERS = {consumer: producer for producer, consumers in CONSUMERS.items() for consumer in consumers}
+
+    def __init__(self, x_dim, h_dim1, h_dim2, z_dim, class_size=10, max_h_dim1=None, max_h_dim2=None):
+        super(CapacityCVAE, self).__init__(x_dim, max_h_dim1 or h_dim1, max_h_dim2 or h_dim2, z_dim, class_size)
+        # end of the active slice of every hidden layer, kept as python ints so the forward pass never syncs on the masks
+        self.extents = {}
+        for name, width in (('fc1', h_dim1), ('fc2', h_dim2), ('fc4', h_dim2), ('fc5', h_dim1)):
+            self.register_buffer('active_' + name, torch.zeros(getattr(self, name).out_features, dtype=torch.bool), persistent=False)
+            self.set_active_(name, torch.arange(width))
+        with torch.no_grad():
+            # nn.Linear drew the weights with the bound 1/sqrt(in_features) of the maximum widths, they are redrawn with
+            # the fan-in of the active inputs, as in a plain OneHotCVAE of the active widths
+            for name, layer in self.named_children():
+                if isinstance(layer, nn.Linear):
+                    fan_in = self.active_width(self.PRODUCERS[name]) if name in self.PRODUCERS else layer.in_features
+                    bound = fan_in ** -0.5
+                    layer.weight.uniform_(-bound, bound)
+                    layer.bias.uniform_(-bound, bound)
+        for name in self.CONSUMERS:
+            self._zero_inactive_inputs_(name)
+
+    def active_mask(self, name):
+        return getattr(self, 'active_' + name)
+
+    def active_indices(self, name):
+        return torch.nonzero(self.active_mask(name)).squeeze(1)
+
+    def active_width(self, name):
+        return int(self.active_mask(name).sum())
+
+    def _update_extent(self, name):
+        active = self.active_indices(name)
+        self.extents[name] = int(active[-1]) + 1 if active.numel() != 0 else 0
+
+    def set_active_(self, name, neuron_indices):
+        mask = self.active_mask(name)
+        mask.zero_()
+        mask[torch.as_tensor(neuron_indices, dtype=torch.long, device=mask.device)] = True
+        self._update_extent(name)
+
+    def _zero_inactive_inputs_(self, name, optimizer=None):
+        # zeroes the consumer columns of the inactive neurons of layer name, and their optimizer state (if any) so that
+        # the moments left from before a prune do not move them away from zero
+        inactive = torch.nonzero(~self.active_mask(name)).squeeze(1)
+        with torch.no_grad():
+            for consumer in self.CONSUMERS[name]:
+                weight = getattr(self, consumer).weight
+                weight.index_fill_(1, inactive, 0)
+                if optimizer is not None:
+                    for value in optimizer.state.get(weight, {}).values():
+                        if torch.is_tensor(value) and value.shape == weight.shape:
+                            value.index_fill_(1, inactive, 0)
+
+    def prune_neurons_(self, name, neuron_indices, optimizer=None):
+        self.active_mask(name)[torch.as_tensor(neuron_indices, dtype=torch.long, device=self.active_mask(name).device)] = False
+        self._update_extent(name)
+        self._zero_inactive_inputs_(name, optimizer)
+
+    def grow_neurons_(self, name, n_neurons, perturbation=0.01, optimizer=None):
+        # activates the n_neurons lowest free slots of layer name, their weights, biases and the matching columns of the
+        # consumers are redrawn from N(0, perturbation^2) in place and their optimizer state (if any) is zeroed
+        # returns the slots, raises ValueError once the capacity is used up
+        mask = self.active_mask(name)
+        slots = torch.nonzero(~mask).squeeze(1)[:n_neurons]
+        if slots.numel() < n_neurons:
+            raise ValueError(f"{name} has {slots.numel()} free neurons left, cannot grow {n_neurons}, use a larger capacity")
+        layer = getattr(self, name)
+        params = [(layer.weight, 0), (layer.bias, 0)] + [(getattr(self, consumer).weight, 1) for consumer in self.CONSUMERS[name]]
+        with torch.no_grad():
+            for param, dim in params:
+                param.index_copy_(dim, slots, torch.randn_like(param.index_select(dim, slots)) * perturbation)
+                if optimizer is not None:
+                    for value in optimizer.state.get(param, {}).values():
+                        if torch.is_tensor(value) and value.shape == param.shape:
+                            value.index_fill_(dim, slots, 0)
+        mask[slots] = True
+        self._update_extent(name)
+        return slots
+
+    def _active_linear(self, name, inputs, c=None):
+        # output of layer name over its first extents[name] neurons (all of them for the other layers), inactive ones zeroed,
+        # the input columns follow the active slice of the producer, c as in OneHotCVAE._conditioned_linear
+        layer = getattr(self, name)
+        n_out = self.extents.get(name, layer.out_features)
+        weight, bias = layer.weight[:n_out], layer.bias[:n_out]
+        n_in = inputs.shape[1]
+        if c is not None and c.dim() == 1:
+            out = F.linear(inputs, weight[:, :n_in], bias) + weight[:, n_in:].t()[c]
+        else:
+            if c is not None:
+                inputs = torch.cat([inputs, c], dim=1)
+            out = F.linear(inputs, weight[:, :inputs.shape[1]], bias)
+        if name in self.extents:
+            out = out * self.active_mask(name)[:n_out]
+        return out
+
+    def encoder(self, x, c):
+        h = F.relu(self._dropout('fc1', self._active_linear('fc1', x, c)))
+        h = F.relu(self._dropout('fc2', self._active_linear('fc2', h)))
+        return self._dropout('fc31', self._active_linear('fc31', h)), self._dropout('fc32', self._active_linear('fc32', h))
+
+    def decoder(self, z, c, logits=False):
+        h = F.relu(self._dropout('fc4', self._active_linear('fc4', z, c)))
+        h = F.relu(self._dropout('fc5', self._active_linear('fc5', h)))
+        out = self._dropout('fc6', self._active_linear('fc6', h))
+        if logits:
+            return out
+        return torch.sigmoid(out)
+
+    def compact(self):
+        # (OneHotCVAE holding the active neurons only, {layer: (row_map, col_map)} maps from this model's neuron indices
+        # to it, to carry Fisher / MLE dicts over with utils.remap_param_dict)
+        index_maps = {name: (self.active_indices(name), None) for name in self.extents}
+        for producer, consumers in self.CONSUMERS.items():
+            for consumer in consumers:
+                index_maps[consumer] = (index_maps.get(consumer, (None, None))[0], index_maps[producer][0])
+        model_state_dict = {}
+        for name, param in self.named_parameters():
+            row_map, col_map = index_maps.get(name.rsplit('.', 1)[0], (None, None))
+            tensor = param.detach()
+            if row_map is not None:
+                tensor = tensor.index_select(0, row_map)
+            if col_map is not None and tensor.dim() > 1:
+                tensor = tensor.index_select(1, col_map)
+            model_state_dict[name] = tensor
+        return model_from_state_dict(model_state_dict), index_maps
+
+def loss_function(recon_x, x, mu, log_var, reduction='sum', logits=False):
+    # reduction : 'sum' (default) over the batch, 'mean' over the batch or 'none' for the per-sample BCE + KLD vector
+    # logits=True takes the pre-sigmoid decoder output (vae(x, c, logits=True)) and uses the stable BCE-with-logits
+    bce_function = F.binary_cross_entropy_with_logits if logits else F.binary_cross_entropy
+    if reduction == 'sum':
+        BCE = bce_function(recon_x, x.view(-1, 784), reduction='sum')
+        KLD = -0.5 * torch.sum(1 + log_var - mu.pow(2) - log_var.exp())
+        return BCE + KLD
+
+    BCE = bce_function(recon_x, x.view(-1, 784), reduction='none').sum(dim=1)
+    KLD = -0.5 * torch.sum(1 + log_var - mu.pow(2) - log_var.exp(), dim=1)
+    if reduction == 'mean':
+        return (BCE + KLD).mean()
     return BCE + KLD
 
+def fused_loss_function(vae, x_a, c_a, x_b, c_b, logits=False):
+    # runs both batches of a two-term objective (forget / replay, new / replay) through a single forward pass
+    # and splits the per-sample losses back, returns the summed loss of each batch
+    # each batch keeps its own selective dropout draw, as with two separate forward passes
+    n_a = x_a.shape[0]
+    x = torch.cat([x_a.view(-1, 784), x_b.view(-1, 784)], dim=0)
+    c = torch.cat([c_a, c_b], dim=0)
+    vae.dropout_segments = (n_a, x.shape[0] - n_a)
+    try:
+        recon_x, mu, log_var = vae(x, c, logits=logits)
+    finally:
+        vae.dropout_segments = None
+    losses = loss_function(recon_x, x, mu, log_var, reduction='none', logits=logits)
+    return losses[:n_a].sum(), losses[n_a:].sum()
+
+class QuadraticPenalty:
+    # shared training step of the EWC penalties : subclasses provide the differentiable penalty (__call__)
+    # and add_grad_, its closed form gradient added to the .grad of the parameters
+    def backward(self, loss, lmbda, closed_form=False):
+        # loss.backward() for loss + lmbda * penalty, the penalty going through autograd or add_grad_
+        # returns the detached total loss and penalty
+        if closed_form:
+            loss.backward()
+            penalty = self.add_grad_(lmbda)
+        else:
+            penalty = self()
+            (loss + lmbda * penalty).backward()
+            penalty = penalty.detach()
+        return loss.detach() + lmbda * penalty, penalty
+
+class EWCPenalty(QuadraticPenalty):
+    # EWC term sum_i F_i (theta_i - theta*_i)^2 over all the parameters of model,
+    # the Fisher and the anchor (MLE) parameters are flattened once into contiguous vectors on the model's device
+    def __init__(self, model, fisher_dict, params_mle_dict):
+        names = [name for name, _ in model.named_parameters()]
+        self.params = [param for _, param in model.named_parameters()]
+        self.numels = [param.numel() for param in self.params]
+        device = self.params[0].device
+        self.fisher = torch.cat([fisher_dict[name].detach().reshape(-1).to(device) for name in names])
+        self.anchor = torch.cat([params_mle_dict[name].detach().reshape(-1).to(device) for name in names])
+
+    def _flat_params(self):
+        return torch.cat([param.reshape(-1) for param in self.params])
+
+    def __call__(self):
+        # differentiable penalty : one concatenation of the live parameters and one weighted squared difference
+        diff = self._flat_params() - self.anchor
+        return torch.dot(self.fisher, diff * diff)
+
+    def add_grad_(self, lmbda):
+        # closed form alternative to backpropagating lmbda * penalty : adds 2 * lmbda * F * (theta - theta*) to the .grad
+        # of every parameter, to be called between loss.backward() and optimizer.step(), returns the (detached) penalty
+        with torch.no_grad():
+            diff = self._flat_params() - self.anchor
+            weighted_diff = self.fisher * diff
+            penalty = torch.dot(weighted_diff, diff)
+            for param, grad in zip(self.params, (2 * lmbda * weighted_diff).split(self.numels)):
+                if param.grad is None:
+                    param.grad = grad.view_as(param).clone()
+                else:
+                    param.grad.add_(grad.view_as(param))
+        return penalty
+
+class KFACPenalty(QuadraticPenalty):
+    # Kronecker factored version of the EWC term (kfac_dict of calculate_fim.save_fim with --fim_method kfac) : per nn.Linear layer
+    # F ~ A (x) G, so (theta - theta*)^T F (theta - theta*) = sum(dW * (G @ dW @ A)) with dW = [W - W* | b - b*],
+    # which keeps the correlations inside a layer at O(layer dims^2) memory
+    def __init__(self, model, kfac_dict, params_mle_dict):
+        self.layers = []
+        for name, module in model.named_modules():
+            if isinstance(module, nn.Linear) and name in kfac_dict:
+                device = module.weight.device
+                self.layers.append((
+                    module,
+                    kfac_dict[name]['A'].detach().to(device),
+                    kfac_dict[name]['G'].detach().to(device),
+                    params_mle_dict[name + '.weight'].detach().to(device),
+                    params_mle_dict[name + '.bias'].detach().to(device),
+                ))
+
+    def _deltas(self):
+        for module, A, G, weight_mle, bias_mle in self.layers:
+            delta = torch.cat([module.weight - weight_mle, (module.bias - bias_mle).unsqueeze(1)], dim=1)
+            yield module, A, G, delta
+
+    def __call__(self):
+        return sum((delta * (G @ delta @ A)).sum() for _, A, G, delta in self._deltas())
+
+    def add_grad_(self, lmbda):
+        # the gradient of sum(dW * (G dW A)) is 2 G dW A (A and G are symmetric), split back into weight and bias
+        with torch.no_grad():
+            penalty = 0
+            for module, A, G, delta in self._deltas():
+                G_delta_A = G @ delta @ A
+                penalty = penalty + (delta * G_delta_A).sum()
+                grad = 2 * lmbda * G_delta_A
+                for param, param_grad in ((module.weight, grad[:, :-1]), (module.bias, grad[:, -1])):
+                    if param.grad is None:
+                        param.grad = param_grad.contiguous()
+                    else:
+                        param.grad.add_(param_grad)
+        return penalty
+
 def add_weight_regularization(model_state_dict):
     l1_norm_sum = 0
     for layer_name in model_state_dict:
@@ -1,3 +1,5 @@
+python dataset.py --data_path ./dataset
+
 CUDA_VISIBLE_DEVICES="5" python3 train_continual.py --labels_to_learn 3 --ckpt_folder /home/stud-1/aditya/vae/results/mnist/2024_03_26_024855
 
 CUDA_VISIBLE_DEVICES="5" python calculate_fim.py --ckpt_folder /home/stud-1/aditya/vae/results/mnist/2024_03_26_024855
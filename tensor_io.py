@@ -0,0 +1,215 @@
+import torch
+import numpy as np
+import argparse
+import pickle
+import json
+import os
+
+# layout of a .tensors file :
+#   8 bytes   little endian uint64, length N of the header
+#   N bytes   JSON header {name: {"dtype", "shape", "offsets": [begin, end]}, "__metadata__": {...}},
+#             space padded so that the data section starts on a TENSOR_ALIGNMENT boundary
+#   data      raw C-contiguous buffers, each starting on a TENSOR_ALIGNMENT boundary, offsets are relative to the data section
+# so a single tensor can be memory-mapped from its offsets without reading the rest of the file
+TENSOR_ALIGNMENT = 64
+TENSORS_EXTENSION = ".tensors"
+METADATA_KEY = "__metadata__"
+
+_DTYPES = {
+    torch.float64: 'float64',
+    torch.float32: 'float32',
+    torch.float16: 'float16',
+    torch.int64: 'int64',
+    torch.int32: 'int32',
+    torch.int16: 'int16',
+    torch.int8: 'int8',
+    torch.uint8: 'uint8',
+    torch.bool: 'bool',
+}
+
+def _padding(n_bytes):
+    return (-n_bytes) % TENSOR_ALIGNMENT
+
+def save_tensors(path, tensors, metadata=None):
+    # tensors : {name: tensor}, metadata : any JSON serializable value stored in the header
+    header = {}
+    arrays = []
+    offset = 0
+    for name, tensor in tensors.items():
+        if tensor.dtype not in _DTYPES:
+            raise ValueError(f"Unsupported dtype {tensor.dtype} for tensor {name}")
+        array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+        header[name] = {'dtype': _DTYPES[tensor.dtype], 'shape': list(array.shape), 'offsets': [offset, offset + array.nbytes]}
+        arrays.append(array)
+        offset += array.nbytes + _padding(array.nbytes)
+    if metadata is not None:
+        header[METADATA_KEY] = metadata
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * _padding(8 + len(header_bytes))
+
+    # written to a temporary file first so that a reader never maps a half written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for array in arrays:
+            f.write(array.tobytes())
+            f.write(b'\0' * _padding(array.nbytes))
+    os.replace(tmp_path, path)
+
+def read_header(path):
+    # returns the header dict and the file offset of the data section
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    return header, 8 + header_size
+
+def _load_entries(path, header, data_start, names, device=None, mmap=True):
+    tensors = {}
+    for name in names:
+        entry = header[name]
+        begin, end = entry['offsets']
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        count = (end - begin) // dtype.itemsize
+        if count == 0:
+            array = np.zeros(shape, dtype=dtype)
+        elif mmap:
+            # copy-on-write map of this tensor's pages only
+            array = np.memmap(path, dtype=dtype, mode='c', offset=data_start + begin, shape=(count,)).reshape(shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(data_start + begin)
+                array = np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+        tensor = torch.from_numpy(array)
+        tensors[name] = tensor if device is None else tensor.to(device)
+    return tensors
+
+def load_tensors(path, names=None, device=None, mmap=True):
+    # {name: tensor} of the requested names (all if None), memory-mapped unless mmap=False or moved to device
+    header, data_start = read_header(path)
+    if names is None:
+        names = [name for name in header if name != METADATA_KEY]
+    return _load_entries(path, header, data_start, names, device=device, mmap=mmap)
+
+def load_metadata(path):
+    header, _ = read_header(path)
+    return header.get(METADATA_KEY)
+
+def namespace_to_dict(namespace):
+    return {key: namespace_to_dict(value) if isinstance(value, argparse.Namespace) else value for key, value in vars(namespace).items()}
+
+def dict_to_namespace(config):
+    # same as utils.dict2namespace, kept here so that this module only depends on torch and numpy
+    namespace = argparse.Namespace()
+    for key, value in config.items():
+        setattr(namespace, key, dict_to_namespace(value) if isinstance(value, dict) else value)
+    return namespace
+
+# checkpoints : the tensors of a group (the model state_dict under "model", optionally "fisher_dict", ...) are stored as
+# "<group>/<name>", the config and the remaining JSON serializable fields (labels, h_dims1, ...) go to the metadata
+
+def save_checkpoint(path, model_state_dict, config=None, tensor_groups=None, **fields):
+    tensors = {f"model/{name}": tensor for name, tensor in model_state_dict.items()}
+    metadata = dict(fields)
+    for group, group_tensors in (tensor_groups or {}).items():
+        if group_tensors is None:
+            metadata[group] = None
+            continue
+        tensors.update({f"{group}/{name}": tensor for name, tensor in group_tensors.items()})
+    if config is not None:
+        metadata['config'] = namespace_to_dict(config)
+    save_tensors(path, tensors, metadata)
+
+def resolve_checkpoint(path):
+    # path with or without extension -> the .tensors file if there is one, else the legacy .pt
+    stem, extension = os.path.splitext(path)
+    if extension not in ('.pt', TENSORS_EXTENSION):
+        stem = path
+    for candidate in (stem + TENSORS_EXTENSION, stem + '.pt'):
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+def load_checkpoint(path, names=None, groups=None, device=None):
+    # checkpoint dict laid out like the legacy torch.save ones : {'model': state_dict, 'config': Namespace, ...}
+    # names restricts the mapped model tensors (e.g. only the decoder for sampling), groups the other tensor groups (all if None)
+    path = resolve_checkpoint(path)
+    if not path.endswith(TENSORS_EXTENSION):
+        return torch.load(path, map_location=device)
+
+    header, data_start = read_header(path)
+    ckpt = dict(header.get(METADATA_KEY) or {})
+    if 'config' in ckpt:
+        ckpt['config'] = dict_to_namespace(ckpt['config'])
+
+    keys = []
+    for key in header:
+        if key == METADATA_KEY:
+            continue
+        group, name = key.split('/', 1)
+        if group == 'model' and names is not None and name not in names:
+            continue
+        if group != 'model' and groups is not None and group not in groups:
+            continue
+        keys.append(key)
+
+    ckpt['model'] = {}
+    for key, tensor in _load_entries(path, header, data_start, keys, device=device).items():
+        group, name = key.split('/', 1)
+        ckpt.setdefault(group, {})[name] = tensor
+    return ckpt
+
+# Fisher dicts : {param_name: tensor} (fisher_dict) or {layer_name: {factor: tensor}} (kfac_dict), nested names are joined with "/"
+
+def save_fisher_dict(directory, fisher_dict, name='fisher_dict'):
+    tensors = {}
+    for key, value in fisher_dict.items():
+        if isinstance(value, dict):
+            tensors.update({f"{key}/{inner_key}": tensor for inner_key, tensor in value.items()})
+        else:
+            tensors[key] = value
+    save_tensors(os.path.join(directory, name + TENSORS_EXTENSION), tensors)
+
+def load_fisher_dict(directory, name='fisher_dict', device=None):
+    # reads <name>.tensors, or the legacy pickled <name>.pkl
+    path = os.path.join(directory, name + TENSORS_EXTENSION)
+    if not os.path.exists(path):
+        with open(os.path.join(directory, name + '.pkl'), 'rb') as f:
+            fisher_dict = pickle.load(f)
+        return fisher_dict
+
+    fisher_dict = {}
+    for key, tensor in load_tensors(path, device=device).items():
+        if '/' in key:
+            outer_key, inner_key = key.split('/', 1)
+            fisher_dict.setdefault(outer_key, {})[inner_key] = tensor
+        else:
+            fisher_dict[key] = tensor
+    return fisher_dict
+
+def import_legacy(path):
+    # converts a torch.save checkpoint (.pt) or a pickled Fisher dict (.pkl) into a .tensors file next to it
+    stem, extension = os.path.splitext(path)
+    if extension == '.pkl':
+        with open(path, 'rb') as f:
+            fisher_dict = pickle.load(f)
+        save_fisher_dict(os.path.dirname(path), fisher_dict, name=os.path.basename(stem))
+    elif extension == '.pt':
+        ckpt = torch.load(path, map_location='cpu')
+        model_state_dict = ckpt.pop('model')
+        config = ckpt.pop('config', None)
+        tensor_groups = {key: ckpt.pop(key) for key in list(ckpt) if isinstance(ckpt[key], dict)}
+        save_checkpoint(stem + TENSORS_EXTENSION, model_state_dict, config, tensor_groups, **ckpt)
+    else:
+        raise ValueError(f"Don't know how to import {path}, expected a .pt checkpoint or a .pkl Fisher dict")
+    return stem + TENSORS_EXTENSION
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", type=str, nargs='+', help='ckpt.pt / fisher_dict.pkl files to convert to the .tensors format')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        print("converted ", path, "to ", import_legacy(path))
@@ -42,9 +42,9 @@ import torch
 from utils import evaluate_with_classifier
 from model import OneHotCVAE
 from model import Classifier
+from dataset import MNIST_Custom
 from tqdm import tqdm
 from torch.utils.data import Dataset, DataLoader
-from torchvision import datasets, transforms
 
 # ckpt_path = "/home/stud-1/aditya/vae/results/mnist/2024_04_09_165401/ckpts"
 ckpt_path = "/home/stud-1/aditya/vae/run0/mnist/initial/ckpts"
@@ -68,7 +68,7 @@ majority_count = 0
 total = 0
 
 # load the MNIST dataset
-test_dataset = datasets.MNIST("./dataset", train=False, download=True, transform=transforms.ToTensor())
+test_dataset = MNIST_Custom(digits=list(range(10)), data_path="./dataset", train=False, download=True, in_memory=True)
 test_loader = DataLoader(test_dataset, batch_size=1, shuffle=True)
 
 for i in tqdm(range(10000)):
@@ -1,12 +1,12 @@
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
-from torchvision import datasets, transforms
+from torchvision import transforms
 from dataset import MNIST_Custom
 from torchvision.utils import save_image, make_grid
-import pickle
-from model import OneHotCVAE, loss_function
-from utils import setup_dirs, cycle
+from model import OneHotCVAE, loss_function, fused_loss_function
+from utils import setup_dirs, cycle_tensors, GenerativeReplayBank
+from tensor_io import load_checkpoint, save_checkpoint, load_fisher_dict, TENSORS_EXTENSION
 import os
 import argparse
 import logging
@@ -37,6 +37,18 @@ def parse_args_and_ckpt():
     parser.add_argument(
         "--lmbda", type=float, default = 100, help = "Lambda hyperparameter for EWC term in loss"
     )
+
+    parser.add_argument(
+        "--replay_bank_size", type=int, default=1000, help='Replay samples per remembered label, see utils.GenerativeReplayBank'
+    )
+
+    parser.add_argument(
+        "--replay_refresh", type=int, default=1000, help='Steps between two partial redraws of the replay bank (0 never)'
+    )
+
+    parser.add_argument(
+        "--fused_forward", type=int, default=1, help='One forward pass for both loss terms, see model.fused_loss_function'
+    )
     
     parser.add_argument(
         "--gamma", type=float, default = 1, help = "Gamma hyperparameter for contrastive term in loss (left at 1 in main paper)"
@@ -63,7 +75,7 @@ def parse_args_and_ckpt():
     )
     
     args = parser.parse_args()
-    ckpt = torch.load(os.path.join(args.ckpt_folder, "ckpts/ckpt_modified.pt"), map_location=device)
+    ckpt = load_checkpoint(os.path.join(args.ckpt_folder, "ckpts/ckpt_modified"), device=device)
     old_config = ckpt['config']
     new_config = setup_dirs(copy.deepcopy(old_config))
     
@@ -92,6 +104,7 @@ def train():
 
     labels_to_remember = ckpt['labels']
     labels_to_learn = args.labels_to_learn
+    replay = GenerativeReplayBank(vae_clone, labels_to_remember, new_config.z_dim, args.replay_bank_size, device, refresh_every=args.replay_refresh)
     
     vae.train()
     train_loss = 0
@@ -104,9 +117,7 @@ def train():
         # data = data.to(device)
         # label = label.to(device)
         
-        c_remember = torch.from_numpy(np.random.choice(labels_to_remember, size=args.batch_size)).to(device)
-        c_remember = F.one_hot(c_remember, 10)
-        z_remember = torch.randn((args.batch_size, new_config.z_dim)).to(device)
+        out_remember, c_remember = replay.sample(args.batch_size)
         
         # c_forget = (torch.ones(args.batch_size, dtype=int) * args.label_to_drop).to(device)
         # c_forget = F.one_hot(c_forget, 10)
@@ -114,26 +125,26 @@ def train():
         # c_new = torch.from_numpy(np.random.choice(labels_to_learn, size=args.batch_size)).to(device)
         # c_new = F.one_hot(c_new, 10)
         out_new, c_new = next(train_iter)
-        c_new = F.one_hot(c_new, 10)
         out_new = out_new.to(device)
         c_new = c_new.to(device)
 
-        with torch.no_grad():
-            out_remember = vae_clone.decoder(z_remember, c_remember).view(-1, 1, 28, 28)
-
         optimizer.zero_grad()
                 
         # # corrupting loss
         # recon_batch, mu, log_var = vae(out_forget, c_forget)
         # loss = loss_function(recon_batch, out_forget, mu, log_var)
         
-        # learning loss
-        recon_batch, mu, log_var = vae(out_new, c_new)
-        loss = loss_function(recon_batch, out_new, mu, log_var)
-        
-        # contrastive loss
-        recon_batch, mu, log_var = vae(out_remember, c_remember)
-        loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
+        if args.fused_forward:
+            loss_new, loss_remember = fused_loss_function(vae, out_new, c_new, out_remember, c_remember)
+            loss = loss_new + args.gamma * loss_remember
+        else:
+            # learning loss
+            recon_batch, mu, log_var = vae(out_new, c_new)
+            loss = loss_function(recon_batch, out_new, mu, log_var)
+            
+            # contrastive loss
+            recon_batch, mu, log_var = vae(out_remember, c_remember)
+            loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
         
         learning_loss += loss / args.log_freq
         
@@ -186,14 +197,13 @@ if __name__ == "__main__":
     logging.info(f"Current Digits: {ckpt['labels']}, New Digits to Learn : {args.labels_to_learn}, lambda: {args.lmbda}, gamma: {args.gamma}")
 
     # MNIST Dataset
-    train_dataset = MNIST_Custom(digits=args.labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
-    test_dataset = MNIST_Custom(digits=args.labels_to_learn, data_path=args.data_path, train=False, transform=transforms.ToTensor(), download=False)
+    train_dataset = MNIST_Custom(digits=args.labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
+    test_dataset = MNIST_Custom(digits=args.labels_to_learn, data_path=args.data_path, train=False, transform=transforms.ToTensor(), download=False, in_memory=True)
 
     # Data Loader (Input Pipeline)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False)
 
-    train_iter = cycle(train_loader)
+    train_iter = cycle_tensors(train_dataset.data, train_dataset.targets, args.batch_size, device)
 
     # build model
     vae = OneHotCVAE(x_dim=new_config.x_dim, h_dim1= new_config.h_dim1, h_dim2=new_config.h_dim2, z_dim=new_config.z_dim)
@@ -206,14 +216,9 @@ if __name__ == "__main__":
     for name, param in vae.named_parameters():
         params_mle_dict[name] = param.data.clone()
 
-    with open(os.path.join(old_config.exp_root_dir, 'fisher_dict.pkl'), 'rb') as f:
-        fisher_dict = pickle.load(f)
+    fisher_dict = load_fisher_dict(old_config.exp_root_dir, device=device)
     
     optimizer = optim.Adam(vae.parameters(), lr=args.lr)
 
     train()
-    torch.save({
-            "model": vae.state_dict(),
-            "config": new_config
-        },
-        os.path.join(new_config.ckpt_dir, "ckpt.pt"))
\ No newline at end of file
+    save_checkpoint(os.path.join(new_config.ckpt_dir, "ckpt" + TENSORS_EXTENSION), vae.state_dict(), new_config)
\ No newline at end of file
@@ -2,14 +2,16 @@
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from torchvision import datasets, transforms
+from torchvision import transforms
 from torchvision.utils import save_image, make_grid
 import argparse
 import os
 import logging
 from tqdm import tqdm
 
-from utils import get_config_and_setup_dirs, cycle
+from dataset import MNIST_Custom
+from utils import get_config_and_setup_dirs, cycle_tensors
+from tensor_io import save_checkpoint, TENSORS_EXTENSION
 from model import OneHotCVAE, loss_function
 
 
@@ -68,7 +70,6 @@ def train():
     train_loss = 0
     for step in tqdm(range(0, args.n_iters)):
         data, label = next(train_iter)
-        label = F.one_hot(label, 10)
         data = data.to(device)
         label = label.to(device)
         optimizer.zero_grad()
@@ -92,7 +93,6 @@ def test():
     test_loss= 0
     with torch.no_grad():
         for data, label in test_loader:
-            label = F.one_hot(label, 10)
             data = data.to(device)
             label = label.to(device)
             recon, mu, log_var = vae(data, label)
@@ -125,14 +125,13 @@ if __name__ == "__main__":
     logging.info(f"Beginning basic training of conditional VAE")
     
     # MNIST Dataset
-    train_dataset = datasets.MNIST(root=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
-    test_dataset = datasets.MNIST(root=args.data_path, train=False, transform=transforms.ToTensor(), download=False)
+    train_dataset = MNIST_Custom(digits=list(range(10)), data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
+    test_dataset = MNIST_Custom(digits=list(range(10)), data_path=args.data_path, train=False, transform=transforms.ToTensor(), download=False, in_memory=True)
 
     # Data Loader (Input Pipeline)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=4)
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False)
 
-    train_iter = cycle(train_loader)
+    train_iter = cycle_tensors(train_dataset.data, train_dataset.targets, args.batch_size, device)
     
     # build model
     vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim)
@@ -141,8 +140,4 @@ if __name__ == "__main__":
     optimizer = optim.Adam(vae.parameters(), lr=args.lr)
     
     train()
-    torch.save({
-            "model": vae.state_dict(),
-            "config": config
-        },
-        os.path.join(config.ckpt_dir, "ckpt.pt"))
+    save_checkpoint(os.path.join(config.ckpt_dir, "ckpt" + TENSORS_EXTENSION), vae.state_dict(), config)
@@ -3,13 +3,13 @@ import torch.optim as optim
 import torch.nn.functional as F
 from torchvision.utils import save_image, make_grid
 import pickle
-from model import OneHotCVAE, loss_function
-from utils import setup_dirs, prune_model_using_dag
+from model import OneHotCVAE, loss_function, fused_loss_function
+from utils import setup_dirs, prune_model_using_dag, model_from_state_dict, GenerativeReplayBank
+from tensor_io import load_checkpoint, save_checkpoint, TENSORS_EXTENSION
 import os
 import argparse
 import logging
 import copy
-import numpy as np
 
 
 def parse_args_and_ckpt():
@@ -26,6 +26,18 @@ def parse_args_and_ckpt():
     parser.add_argument(
         "--lmbda", type=float, default = 100, help = "Lambda hyperparameter for EWC term in loss"
     )
+
+    parser.add_argument(
+        "--replay_bank_size", type=int, default=1000, help='Replay samples per remembered label, see utils.GenerativeReplayBank'
+    )
+
+    parser.add_argument(
+        "--replay_refresh", type=int, default=1000, help='Steps between two partial redraws of the replay bank (0 never)'
+    )
+
+    parser.add_argument(
+        "--fused_forward", type=int, default=1, help='One forward pass for both loss terms, see model.fused_loss_function'
+    )
     
     parser.add_argument(
         "--gamma", type=float, default = 1, help = "Gamma hyperparameter for contrastive term in loss (left at 1 in main paper)"
@@ -52,7 +64,7 @@ def parse_args_and_ckpt():
     )
     
     args = parser.parse_args()
-    ckpt = torch.load(os.path.join(args.ckpt_folder, "ckpts/ckpt.pt"), map_location=device)
+    ckpt = load_checkpoint(os.path.join(args.ckpt_folder, "ckpts/ckpt"), device=device)
     old_config = ckpt['config']
     new_config = setup_dirs(copy.deepcopy(old_config))
     
@@ -78,6 +90,7 @@ def train():
     
     label_choices = list(range(10))
     label_choices.remove(args.label_to_drop)
+    replay = GenerativeReplayBank(vae_clone, label_choices, new_config.z_dim, args.replay_bank_size, device, refresh_every=args.replay_refresh)
     
     vae2.train()
     train_loss = 0
@@ -86,26 +99,24 @@ def train():
     
     for step in range(0, args.n_iters):
         
-        c_remember = torch.from_numpy(np.random.choice(label_choices, size=args.batch_size)).to(device)
-        c_remember = F.one_hot(c_remember, 10)
-        z_remember = torch.randn((args.batch_size, new_config.z_dim)).to(device)
+        out_remember, c_remember = replay.sample(args.batch_size)
         
         c_forget = (torch.ones(args.batch_size, dtype=int) * args.label_to_drop).to(device)
-        c_forget = F.one_hot(c_forget, 10)
         out_forget = torch.rand((args.batch_size, 1, 28, 28)).to(device)
 
-        with torch.no_grad():
-            out_remember = vae_clone.decoder(z_remember, c_remember).view(-1, 1, 28, 28)
-
         optimizer2.zero_grad()
                 
-        # corrupting loss
-        recon_batch, mu, log_var = vae2(out_forget, c_forget)
-        loss = loss_function(recon_batch, out_forget, mu, log_var)
-        
-        # contrastive loss
-        recon_batch, mu, log_var = vae2(out_remember, c_remember)
-        loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
+        if args.fused_forward:
+            loss_forget, loss_remember = fused_loss_function(vae2, out_forget, c_forget, out_remember, c_remember)
+            loss = loss_forget + args.gamma * loss_remember
+        else:
+            # corrupting loss
+            recon_batch, mu, log_var = vae2(out_forget, c_forget)
+            loss = loss_function(recon_batch, out_forget, mu, log_var)
+            
+            # contrastive loss
+            recon_batch, mu, log_var = vae2(out_remember, c_remember)
+            loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
         
         forgetting_loss += loss / args.log_freq
         
@@ -166,18 +177,10 @@ if __name__ == "__main__":
     
     optimizer = optim.Adam(vae.parameters(), lr=args.lr)
     state_dict = vae.state_dict()
-    pruned_state_dict = prune_model_using_dag(state_dict, type=2)
-    h_dim1 = pruned_state_dict['fc1.weight'].shape[0]
-    h_dim2 = pruned_state_dict['fc2.weight'].shape[0]
-    vae2 = OneHotCVAE(x_dim=new_config.x_dim, h_dim1=h_dim1, h_dim2=h_dim2, z_dim=new_config.z_dim)
-    vae2.load_state_dict(pruned_state_dict)
-    vae2 = vae2.to(device)
+    pruned_state_dict = prune_model_using_dag(state_dict, type=2, model=vae)
+    vae2 = model_from_state_dict(pruned_state_dict).to(device)
     vae2.train()
     # vae = copy.deepcopy(vae2)
     optimizer2 = optim.Adam(vae2.parameters(), lr=args.lr)
     train()
-    torch.save({
-            "model": vae2.state_dict(),
-            "config": new_config
-        },
-        os.path.join(new_config.ckpt_dir, "ckpt.pt"))
\ No newline at end of file
+    save_checkpoint(os.path.join(new_config.ckpt_dir, "ckpt" + TENSORS_EXTENSION), vae2.state_dict(), new_config)
\ No newline at end of file
@@ -2,7 +2,7 @@
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from torchvision import datasets, transforms
+from torchvision import transforms
 from torchvision.utils import save_image, make_grid
 import argparse
 import os
@@ -10,12 +10,12 @@ import logging
 from tqdm import tqdm
 import copy
 import numpy as np
-import pickle
 
 from calculate_fim import save_fim
 from dataset import MNIST_Custom
-from utils import get_config_and_setup_dirs_final, cycle
-from model import OneHotCVAE, loss_function
+from utils import get_config_and_setup_dirs_final, cycle_tensors, GenerativeReplayBank
+from tensor_io import save_checkpoint, load_fisher_dict, TENSORS_EXTENSION
+from model import OneHotCVAE, loss_function, fused_loss_function, EWCPenalty, KFACPenalty
 
 NUM_TRAIN_EPOCHS = {
     1: 20000,
@@ -58,6 +58,26 @@ def parse_args_and_config():
         "--n_fim_samples", type=int, default=50000, help="Number of samples to calculate FIM with. Only applicable for true FIM."
     )
     
+    parser.add_argument(
+        "--fim_batch_size", type=int, default=1000, help="Number of samples per vectorized per-sample gradient pass"
+    )
+
+    parser.add_argument(
+        "--fim_method", type=str, default="vmap", choices=["vmap", "analytic", "kfac"], help="vmap : vectorized per-sample gradients, analytic : per-layer outer products from hooked activations (lower memory), kfac : Kronecker factors saved to kfac_dict.tensors (and their diagonal)"
+    )
+
+    parser.add_argument(
+        "--fim_tol", type=float, default=None, help="Stop the FIM estimation once its relative standard error is below this tolerance, n_fim_samples becomes the cap"
+    )
+
+    parser.add_argument(
+        "--n_workers", type=int, default=1, help="Number of CPU worker processes the FIM samples are sharded over (1 computes it in process)"
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the worker RNG streams (one independent stream per worker, spawned from it) for the sharded FIM"
+    )
+    
     parser.add_argument(
         "--n_vis_samples", type=int, default=100, help='Number of samples to visualize while logging'
     )
@@ -74,7 +94,29 @@ def parse_args_and_config():
         "--lmbda", type=float, default = 100, help = "Lambda hyperparameter for EWC term in loss"
     )
 
+    parser.add_argument(
+        "--ewc_type", type=str, default="diag", choices=["diag", "kfac"], help='EWC penalty from the diagonal FIM or from its Kronecker factors (with --fim_method kfac)'
+    )
+
+    parser.add_argument(
+        "--ewc_grad", type=str, default="autograd", choices=["autograd", "closed_form"], help='Backpropagate the EWC term or add its closed form gradient directly'
+    )
+
+    parser.add_argument(
+        "--replay_bank_size", type=int, default=1000, help='Replay samples per remembered label, see utils.GenerativeReplayBank'
+    )
+
+    parser.add_argument(
+        "--replay_refresh", type=int, default=1000, help='Steps between two partial redraws of the replay bank (0 never)'
+    )
+
+    parser.add_argument(
+        "--fused_forward", type=int, default=1, help='One forward pass for both loss terms, see model.fused_loss_function'
+    )
+
     args = parser.parse_args()
+    if args.ewc_type == "kfac" and args.fim_method != "kfac":
+        parser.error("--ewc_type kfac needs the Kronecker factors of --fim_method kfac")
     config = get_config_and_setup_dirs_final(args.config)
 
     handler1 = logging.StreamHandler()
@@ -98,7 +140,6 @@ def train(vae, args, config, optimizer, n_iters, device, train_iter, test_loader
     train_loss = 0
     for step in tqdm(range(0, n_iters)):
         data, label = next(train_iter)
-        label = F.one_hot(label, 10)
         data = data.to(device)
         label = label.to(device)
         optimizer.zero_grad()
@@ -122,7 +163,6 @@ def test(vae, test_loader, device):
     test_loss= 0
     with torch.no_grad():
         for data, label in test_loader:
-            label = F.one_hot(label, 10)
             data = data.to(device)
             label = label.to(device)
             recon, mu, log_var = vae(data, label)
@@ -151,13 +191,18 @@ def forget(vae, args, config, device, optimizer, learnt_labels, labels_to_forget
     vae_clone.eval()
     
     labels_retained = [i for i in learnt_labels if i not in labels_to_forget]
+    replay = GenerativeReplayBank(vae_clone, labels_retained, config.z_dim, args.replay_bank_size, device, refresh_every=args.replay_refresh)
     
     params_mle_dict = {}
     for name, param in vae.named_parameters():
         params_mle_dict[name] = param.data.clone()
     
-    with open(os.path.join(config.exp_root_dir, 'fisher_dict.pkl'), 'rb') as f:
-        fisher_dict = pickle.load(f)
+    if args.ewc_type == "kfac":
+        kfac_dict = load_fisher_dict(config.exp_root_dir, name='kfac_dict', device=device)
+        ewc = KFACPenalty(vae, kfac_dict, params_mle_dict)
+    else:
+        fisher_dict = load_fisher_dict(config.exp_root_dir, device=device)
+        ewc = EWCPenalty(vae, fisher_dict, params_mle_dict)
     
     vae.train()
     train_loss = 0
@@ -166,36 +211,31 @@ def forget(vae, args, config, device, optimizer, learnt_labels, labels_to_forget
     
     for step in tqdm(range(0, n_iter)):
         
-        c_remember = torch.from_numpy(np.random.choice(labels_retained, size=args.batch_size)).to(device)
-        c_remember = F.one_hot(c_remember, 10)
-        z_remember = torch.randn((args.batch_size, config.z_dim)).to(device)
+        out_remember, c_remember = replay.sample(args.batch_size)
         
         # small modification to the code to incorporate cases when labels_to_forget is a list of labels and not a single label
         c_forget = torch.from_numpy(np.random.choice(labels_to_forget, size=args.batch_size)).to(device)
-        c_forget = F.one_hot(c_forget, 10)
         out_forget = torch.rand((args.batch_size, 1, 28, 28)).to(device)
 
-        with torch.no_grad():
-            out_remember = vae_clone.decoder(z_remember, c_remember).view(-1, 1, 28, 28)
-
         optimizer.zero_grad()
 
-        # corrupting loss
-        recon_batch, mu, log_var = vae(out_forget, c_forget)
-        loss = loss_function(recon_batch, out_forget, mu, log_var)
-        
-        # contrastive loss
-        recon_batch, mu, log_var = vae(out_remember, c_remember)
-        loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
+        if args.fused_forward:
+            loss_forget, loss_remember = fused_loss_function(vae, out_forget, c_forget, out_remember, c_remember)
+            loss = loss_forget + args.gamma * loss_remember
+        else:
+            # corrupting loss
+            recon_batch, mu, log_var = vae(out_forget, c_forget)
+            loss = loss_function(recon_batch, out_forget, mu, log_var)
+            
+            # contrastive loss
+            recon_batch, mu, log_var = vae(out_remember, c_remember)
+            loss += args.gamma * loss_function(recon_batch, out_remember, mu, log_var)
         
         forgetting_loss += loss / args.log_freq
         
-        for n, p in vae.named_parameters():
-            _loss = fisher_dict[n].to(device) * (p - params_mle_dict[n].to(device)) ** 2
-            loss += args.lmbda * _loss.sum()
-            ewc_loss += args.lmbda * _loss.sum() / args.log_freq
+        loss, penalty = ewc.backward(loss, args.lmbda, closed_form=args.ewc_grad == "closed_form")
+        ewc_loss += args.lmbda * penalty / args.log_freq
         
-        loss.backward()
         train_loss += loss.item() / args.log_freq
         optimizer.step()
         
@@ -218,14 +258,13 @@ def train_sa_vae(args, config, labels_to_learn, labels_to_forget):
     logging.info(f"Beginning basic training of conditional VAE")
     
     # MNIST Dataset
-    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
-    test_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
+    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
+    test_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
 
     # Data Loader (Input Pipeline)
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True)
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False)
 
-    train_iter = cycle(train_loader)
+    train_iter = cycle_tensors(train_dataset.data, train_dataset.targets, args.batch_size, device)
     
     # build model
     vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim)
@@ -237,11 +276,7 @@ def train_sa_vae(args, config, labels_to_learn, labels_to_forget):
     save_fim(vae, args, config, device)
     forget(vae, args, config, device, optimizer, labels_to_learn, labels_to_forget, NUM_TRAIN_EPOCHS[len(labels_to_learn) - len(labels_to_forget)])
     
-    torch.save({
-            "model": vae.state_dict(),
-            "config": config
-        },
-        os.path.join(config.ckpt_dir, "sa_vae.pt"))
+    save_checkpoint(os.path.join(config.ckpt_dir, "sa_vae" + TENSORS_EXTENSION), vae.state_dict(), config)
 
 if __name__=="__main__":
     args, config = parse_args_and_config()
@@ -10,7 +10,8 @@ import os
 import logging
 from tqdm import tqdm
 from dataset import MNIST_Custom
-from utils import get_config_and_setup_dirs_final, cycle
+from utils import get_config_and_setup_dirs_final, cycle_tensors
+from tensor_io import save_checkpoint, TENSORS_EXTENSION
 from model import OneHotCVAE, loss_function
 
 NUM_TRAIN_EPOCHS = {
@@ -80,7 +81,6 @@ def train(vae, args, config, optimizer, n_iters, device, train_iter, test_loader
     train_loss = 0
     for step in tqdm(range(0, n_iters)):
         data, label = next(train_iter)
-        label = F.one_hot(label, 10)
         data = data.to(device)
         label = label.to(device)
         optimizer.zero_grad()
@@ -104,7 +104,6 @@ def test(vae, test_loader, device):
     test_loss= 0
     with torch.no_grad():
         for data, label in test_loader:
-            label = F.one_hot(label, 10)
             data = data.to(device)
             label = label.to(device)
             recon, mu, log_var = vae(data, label)
@@ -137,14 +136,13 @@ def train_specialized_model(args, config, labels_to_learn):
     logging.info(f"Beginning basic training of specialized VAE")
 
     # MNIST Dataset
-    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
-    test_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True)
+    train_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
+    test_dataset = MNIST_Custom(digits=labels_to_learn, data_path=args.data_path, train=True, transform=transforms.ToTensor(), download=True, in_memory=True)
 
     # Data Loader
-    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, batch_size=args.batch_size, shuffle=True)
     test_loader = torch.utils.data.DataLoader(dataset=test_dataset, batch_size=args.batch_size, shuffle=False)
 
-    train_iter = cycle(train_loader)
+    train_iter = cycle_tensors(train_dataset.data, train_dataset.targets, args.batch_size, device)
 
     # build model
     vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= config.h_dim1, h_dim2=config.h_dim2, z_dim=config.z_dim)
@@ -153,8 +151,4 @@ def train_specialized_model(args, config, labels_to_learn):
     optimizer = optim.Adam(vae.parameters(), lr=args.lr)
     
     train(vae, args, config, optimizer, NUM_TRAIN_EPOCHS[len(labels_to_learn)], device, train_iter, test_loader)
-    torch.save({
-            "model": vae.state_dict(),
-            "config": config
-        },
-        os.path.join(config.ckpt_dir, "specialized_model.pt"))
\ No newline at end of file
+    save_checkpoint(os.path.join(config.ckpt_dir, "specialized_model" + TENSORS_EXTENSION), vae.state_dict(), config)
\ No newline at end of file
@@ -7,11 +7,12 @@ import pandas as pd
 import argparse
 from torchvision import datasets, transforms
 import tqdm
+import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.utils import save_image
-import copy
 from PIL import Image
-from model import Classifier, OneHotCVAE
+from model import Classifier, OneHotCVAE, CapacityCVAE, normalize_keys, fit_linear_shapes_, model_from_state_dict
+from tensor_io import load_checkpoint
 import torchvision.transforms as transforms
 from torch.utils.data import DataLoader
 import pathlib
@@ -115,288 +116,557 @@ def cycle(dl):
         for data in dl:
             yield data
 
-def find_indices_to_drop(model_state_dict, layer_name, hyperparam_k = 0.1): # hardcoded for now ... , may write comprehensive code for this later!
+def cycle_tensors(data, targets, batch_size, device=None):
+    # drop-in replacement for cycle(DataLoader(...)) over preloaded tensors, e.g. MNIST_Custom(in_memory=True).data/.targets
+    # no worker processes : every epoch draws a fresh on-device permutation and batches are gathered by indexing
+    data = data.to(device)
+    targets = targets.to(device)
+    n = data.shape[0]
+    while True:
+        perm = torch.randperm(n, device=data.device)
+        for start in range(0, n, batch_size):
+            idx = perm[start:start + batch_size]
+            yield data[idx], targets[idx]
+
+class GenerativeReplayBank:
+    # replay batches of the labels to remember from the frozen model of a phase : samples_per_label decoder samples of
+    # every label are generated once, in batches of generation_batch_size, and training batches are gathered by index
+    # every refresh_every sampled batches, refresh_fraction of the bank is redrawn to keep some diversity (0 never)
+    # samples_per_label=0 decodes a fresh batch on every call, as the trainers did before
+    def __init__(self, model, labels, z_dim, samples_per_label=1000, device=None, generation_batch_size=1000, refresh_every=0, refresh_fraction=0.1):
+        self.model = model
+        self.z_dim = z_dim
+        self.device = device if device is not None else next(model.parameters()).device
+        self.label_choices = torch.as_tensor(list(labels), dtype=torch.long, device=self.device)
+        self.samples_per_label = samples_per_label
+        self.generation_batch_size = generation_batch_size
+        self.refresh_every = refresh_every
+        self.refresh_fraction = refresh_fraction
+        self.n_batches = 0
+        if samples_per_label > 0:
+            self.labels = self.label_choices.repeat_interleave(samples_per_label)
+            self.images = self._decode(self.labels)
+
+    def _decode(self, labels):
+        with torch.no_grad():
+            images = [
+                self.model.decoder(torch.randn((batch_labels.shape[0], self.z_dim), device=self.device), batch_labels).view(-1, 1, 28, 28)
+                for batch_labels in labels.split(self.generation_batch_size)
+            ]
+        return torch.cat(images)
+
+    def refresh(self, n_samples=None):
+        # redraws n_samples random entries of the bank (refresh_fraction of it if None) in place
+        if n_samples is None:
+            n_samples = max(1, int(self.refresh_fraction * self.labels.shape[0]))
+        idx = torch.randperm(self.labels.shape[0], device=self.device)[:n_samples]
+        self.images[idx] = self._decode(self.labels[idx])
+
+    def sample(self, batch_size):
+        # (images (batch_size, 1, 28, 28), labels (batch_size,)) with the labels uniform over the labels to remember
+        if self.samples_per_label == 0:
+            labels = self.label_choices[torch.randint(self.label_choices.shape[0], (batch_size,), device=self.device)]
+            return self._decode(labels), labels
+        self.n_batches += 1
+        if self.refresh_every and self.n_batches % self.refresh_every == 0:
+            self.refresh()
+        idx = torch.randint(self.labels.shape[0], (batch_size,), device=self.device)
+        return self.images[idx], self.labels[idx]
+
+def l2_importance(model_state_dict, layer_name):
+    # ||w_i||_2 + |b_i| of every output neuron i of layer_name, one reduction over the weight rows
+    scores = torch.linalg.vector_norm(model_state_dict[layer_name + '.weight'], 2, dim=1)
+    if layer_name + '.bias' in model_state_dict:
+        scores = scores + model_state_dict[layer_name + '.bias'].abs()
+    return scores
+
+def fisher_importance(model_state_dict, layer_name, fisher_dict):
+    # sum_j F_ij w_ij^2 + F_i b_i^2 : the diagonal Fisher (EWC) cost of zeroing neuron i
+    weight = model_state_dict[layer_name + '.weight']
+    scores = (fisher_dict[layer_name + '.weight'].to(weight.device) * weight ** 2).sum(dim=1)
+    if layer_name + '.bias' in model_state_dict:
+        bias = model_state_dict[layer_name + '.bias']
+        scores = scores + fisher_dict[layer_name + '.bias'].to(bias.device) * bias ** 2
+    return scores
+
+def activation_importance(model_state_dict, layer_name, activations):
+    # mean |activation| of every output neuron, activations[layer_name] being (batch, out) outputs or an (out,) running mean
+    layer_activations = activations[layer_name].to(model_state_dict[layer_name + '.weight'].device)
+    if layer_activations.dim() > 1:
+        layer_activations = layer_activations.abs().mean(dim=0)
+    return layer_activations
+
+NEURON_IMPORTANCE = {
+    'l2': l2_importance,
+    'fisher': fisher_importance,
+    'activation': activation_importance,
+}
+
+def neuron_importance(model_state_dict, layer_name, score='l2', **score_kwargs):
+    # (out,) importance of the output neurons of layer_name, score picks the function of NEURON_IMPORTANCE,
+    # score_kwargs are its extra inputs (fisher_dict=... / activations=...)
+    return NEURON_IMPORTANCE[score](model_state_dict, layer_name, **score_kwargs)
+
+def bottom_k_indices(scores, hyperparam_k=0.1):
+    # indices of the neurons scoring strictly below the k-th smallest score, k = int(hyperparam_k * n_neurons)
+    k = int(hyperparam_k * scores.shape[0])
+    if k == 0:
+        return torch.zeros(0, dtype=torch.long, device=scores.device)
+    threshold = torch.kthvalue(scores, k).values
+    return torch.nonzero(scores < threshold).squeeze(1)
+
+def find_indices_to_drop(model_state_dict, layer_name, hyperparam_k = 0.1, score='l2', **score_kwargs):
+    # LongTensor of the least important output neurons of layer_name, see neuron_importance and bottom_k_indices
+    # (none for the output layers, LinearGraph.resizable gives them for any model)
     if 'fc31' in layer_name or 'fc32' in layer_name or 'fc6' in layer_name:
-        return []
-    
-    # find the L2 norm of each neuron and store it
-    l2_norm = []
-    for i in range(model_state_dict[layer_name + '.weight'].size()[0]):
-        l2_norm.append(torch.norm(model_state_dict[layer_name + '.weight'][i], 2))
-        # Add the contribution from layer_name.bias
-        l2_norm[-1] += torch.norm(model_state_dict[layer_name + ".bias"][i], 2)
-
-    # find the threshold i.e. the value of the bottom k% of L2 norm
-    if int(hyperparam_k * len(l2_norm)) == 0:
-        return []
-    else:
-        threshold = torch.kthvalue(torch.tensor(l2_norm), int(hyperparam_k * len(l2_norm)))[0]
-    # find the indices of neurons with L2 norm less than threshold
-    indices = []
-    for i in range(len(l2_norm)):
-        if l2_norm[i] < threshold:
-            indices.append(i)
-    return indices
-
-def create_dag(model_state_dict, type=1): # harcoded for now ... , may write comprehensive code for this later!
-    dag = {
-        "fc1.0.weight": ["fc2.0.weight"],
-        "fc2.0.weight": ["fc31.0.weight", "fc32.0.weight"],
-        "fc31.0.weight": ["fc4.0.weight"],
-        "fc32.0.weight": ["fc4.0.weight"],
-        "fc4.0.weight": ["fc5.0.weight"],
-        "fc5.0.weight": ["fc6.0.weight"],
-    }
+        return torch.zeros(0, dtype=torch.long, device=model_state_dict[layer_name + '.weight'].device)
+    scores = neuron_importance(model_state_dict, layer_name, score, **score_kwargs)
+    return bottom_k_indices(scores, hyperparam_k)
+
+class NeuronImportanceTracker:
+    # per-neuron importance of the hidden layers of a live model, read from detached views of its parameters (no state_dict),
+    # for the selective dropout refresh :
+    #   decay == 0 : the scores are those of the current parameters, computed at most once between two step() calls
+    #   decay > 0  : step() folds the current scores into a running average every update_every steps
+    # every layer's scores are sorted once per change, so bottom_k only slices the cached order
+    # layers defaults to the active layers of a CapacityCVAE (inactive neurons are never returned) or the resizable ones,
+    # i.e. the hidden layers : the output layers never had neurons to drop
+    # the bottom_k of every layer feeds OneHotCVAE.set_selective_dropout, which adds the dropout on the first refresh and
+    # afterwards only updates its index buffer
+    def __init__(self, model, layers=None, score='l2', score_kwargs=None, decay=0.0, update_every=1):
+        self.model = model
+        if layers is None:
+            layers = list(model.extents) if isinstance(model, CapacityCVAE) else trace_linear_graph(model).resizable
+        self.layers = layers
+        self.score = score
+        self.score_kwargs = score_kwargs or {}
+        self.decay = decay
+        self.update_every = update_every
+        self.n_steps = 0
+        self.scores = {}
+        self.sorted = {}
+        self.stale = True
+
+    def _current_scores(self):
+        params = {name: param.detach() for name, param in self.model.named_parameters()}
+        scores = {}
+        for name in self.layers:
+            layer_scores = neuron_importance(params, name, self.score, **self.score_kwargs).detach()
+            if isinstance(self.model, CapacityCVAE):
+                layer_scores = layer_scores.masked_fill(~self.model.active_mask(name), float('inf'))
+            scores[name] = layer_scores
+        return scores
+
+    def update(self):
+        # folds the current scores in (or takes them as they are when decay is 0 or a layer was resized)
+        with torch.no_grad():
+            for name, layer_scores in self._current_scores().items():
+                previous = self.scores.get(name)
+                if self.decay == 0 or previous is None or previous.shape != layer_scores.shape:
+                    self.scores[name] = layer_scores
+                else:
+                    self.scores[name] = self.decay * previous + (1 - self.decay) * layer_scores
+                self.sorted.pop(name, None)
+        self.stale = False
+
+    def step(self):
+        # to be called after optimizer.step()
+        self.n_steps += 1
+        if self.decay == 0:
+            self.stale = True
+        elif self.n_steps % self.update_every == 0:
+            self.update()
+
+    def reset(self):
+        # after the model was resized or its masks flipped
+        self.scores = {}
+        self.sorted = {}
+        self.stale = True
+
+    def bottom_k(self, layer_name, hyperparam_k=0.1):
+        # same neurons as bottom_k_indices on the layer's scores : those strictly below the k-th smallest
+        # k = int(hyperparam_k * active neurons), a binary search and a slice of the cached order
+        if self.stale or layer_name not in self.scores:
+            self.update()
+        if layer_name not in self.sorted:
+            self.sorted[layer_name] = torch.sort(self.scores[layer_name])
+        values, order = self.sorted[layer_name]
+        n_neurons = self.model.active_width(layer_name) if isinstance(self.model, CapacityCVAE) else values.shape[0]
+        k = int(hyperparam_k * n_neurons)
+        if k == 0:
+            return order[:0]
+        n_below = int(torch.searchsorted(values, values[k - 1:k]))
+        return order[:n_below]
+
+# autograd nodes that keep the features of their input aligned (activations, dropout masks, ...) : a Linear feeding
+# another one only through these can be resized together with the consumer's columns
+ELEMENTWISE_GRAD_FNS = {
+    'ReluBackward0', 'LeakyReluBackward0', 'EluBackward0', 'GeluBackward0', 'SiluBackward0', 'HardtanhBackward0',
+    'SigmoidBackward0', 'TanhBackward0', 'MulBackward0', 'DivBackward0', 'AddBackward0', 'SubBackward0',
+    'WhereBackward0', 'CloneBackward0', 'NativeDropoutBackward0',
+}
+
+class LinearGraph:
+    # producer -> consumer edges between the nn.Linear layers of a model, see trace_linear_graph
+    #   layers     : the Linear layer names in module order
+    #   producers  : {layer: [Linear layers its input is computed from]}
+    #   consumers  : {layer: [Linear layers its output feeds]}
+    #   resizable  : the hidden layers whose output neurons can be dropped / added, i.e. not a model output and
+    #                feeding each consumer only through ELEMENTWISE_GRAD_FNS, as its whole and only input
+    def __init__(self, layers, edges, exposed, elementwise, in_features, out_features):
+        self.layers = layers
+        self.producers = {name: [producer for producer, consumer in edges if consumer == name] for name in layers}
+        self.consumers = {name: [consumer for producer, consumer in edges if producer == name] for name in layers}
+        self.resizable = [
+            name for name in layers
+            if name not in exposed and len(self.consumers[name]) != 0 and all(
+                elementwise[(name, consumer)] and self.producers[consumer] == [name] and in_features[consumer] == out_features[name]
+                for consumer in self.consumers[name]
+            )
+        ]
+
+def cvae_example_inputs(model, batch_size=2):
+    # (x, one-hot c) for a OneHotCVAE, one-hot so that the Linear modules themselves are called (and hooked)
+    x_dim = model.fc6.out_features
+    class_size = model.fc1.in_features - x_dim
+    device = model.fc1.weight.device
+    c = F.one_hot(torch.arange(batch_size, device=device) % class_size, class_size).float()
+    return torch.zeros(batch_size, x_dim, device=device), c
+
+def trace_linear_graph(model, example_inputs=None):
+    # runs one forward pass with hooks on every nn.Linear and walks the autograd graph back from the input of
+    # each layer to the outputs of the layers it is computed from, and from the model outputs to find the exposed ones
+    if isinstance(model, CapacityCVAE):
+        raise ValueError("CapacityCVAE does not call its nn.Linear modules, trace its compact() export instead")
+    layers = {name: module for name, module in model.named_modules() if isinstance(module, nn.Linear)}
+    if example_inputs is None:
+        example_inputs = cvae_example_inputs(model)
+    inputs, outputs = {}, {}
+    def make_hook(name):
+        def hook(module, args, output):
+            inputs[name] = args[0]
+            outputs[name] = output
+        return hook
+    handles = [module.register_forward_hook(make_hook(name)) for name, module in layers.items()]
+    try:
+        with torch.enable_grad():
+            model_outputs = model(*example_inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    if len(outputs) == 0:
+        raise ValueError(f"None of the nn.Linear layers of {type(model).__name__} was called by its forward pass, there is no graph to trace")
+
+    node_to_layer = {outputs[name].grad_fn: name for name in outputs}
+
+    def producers_of(tensor):
+        # {producer: True if every path from its output to tensor is elementwise}
+        found = {}
+        stack = [(tensor.grad_fn, True)]
+        seen = set()
+        while stack:
+            node, elementwise = stack.pop()
+            if node is None or (node, elementwise) in seen:
+                continue
+            seen.add((node, elementwise))
+            if node in node_to_layer:
+                name = node_to_layer[node]
+                found[name] = found.get(name, True) and elementwise
+                continue
+            elementwise = elementwise and node.name() in ELEMENTWISE_GRAD_FNS
+            stack.extend((next_node, elementwise) for next_node, _ in node.next_functions)
+        return found
+
+    edges, elementwise = [], {}
+    for consumer in layers:
+        if consumer not in inputs:
+            continue
+        for producer, is_elementwise in producers_of(inputs[consumer]).items():
+            edges.append((producer, consumer))
+            elementwise[(producer, consumer)] = is_elementwise
+
+    if torch.is_tensor(model_outputs):
+        model_outputs = (model_outputs,)
+    exposed = set()
+    for output in model_outputs:
+        exposed.update(producers_of(output))
+
+    return LinearGraph(
+        list(layers),
+        edges,
+        exposed,
+        elementwise,
+        {name: module.in_features for name, module in layers.items()},
+        {name: module.out_features for name, module in layers.items()},
+    )
 
-    dag2 = {
-        "fc1.weight": ["fc2.weight"],
-        "fc2.weight": ["fc31.weight", "fc32.weight"],
-        "fc31.weight": ["fc4.weight"],
-        "fc32.weight": ["fc4.weight"],
-        "fc4.weight": ["fc5.weight"],
-        "fc5.weight": ["fc6.weight"],
-    }
-    if type == 1:
-        return dag
-    return dag2
+def resize_linear_state_dict(model_state_dict, graph, row_maps, fill_fn=None, sources=None, col_scales=None):
+    # single pass over the Linear layers of graph : the rows of every layer in row_maps ({layer: map}, see remap_tensor)
+    # follow its map and so do the columns of its consumers, the entries of the new neurons come from
+    # fill_fn(shape, device, dtype) (zeros if None)
+    # sources ({layer: map without -1}) instead copies every new neuron from the old one it names, and
+    # col_scales ({layer: (new width,) factors}) rescales the columns its consumers read it through, see net2net_row_maps
+    # returns the new state_dict (untouched tensors are shared, nothing is copied) and the {layer: (row_map, col_map)} maps
+    sources = sources or {}
+    col_scales = col_scales or {}
+    resized = dict(model_state_dict)
+    index_maps = {}
+    for name in graph.layers:
+        row_map = row_maps.get(name)
+        producers = [producer for producer in graph.producers[name] if producer in row_maps]
+        col_map = row_maps[producers[0]] if len(producers) != 0 else None
+        if row_map is None and col_map is None:
+            continue
+        index_maps[name] = (row_map, col_map)
+        read_rows = sources.get(name, row_map)
+        read_cols = sources.get(producers[0], col_map) if len(producers) != 0 else None
+        col_scale = col_scales.get(producers[0]) if len(producers) != 0 else None
+        for key in (name + '.weight', name + '.bias'):
+            if key not in model_state_dict:
+                continue
+            tensor = model_state_dict[key]
+            fill = None
+            if fill_fn is not None:
+                shape = [tensor.shape[0] if row_map is None else row_map.shape[0]]
+                if tensor.dim() > 1:
+                    shape.append(tensor.shape[1] if col_map is None else col_map.shape[0])
+                fill = fill_fn(tuple(shape), tensor.device, tensor.dtype)
+            resized[key] = remap_tensor(tensor, read_rows, read_cols, fill)
+            if col_scale is not None and tensor.dim() > 1:
+                resized[key] = resized[key] * col_scale.to(tensor.dtype)
+    return resized, index_maps
+
+def _print_shapes(title, model_state_dict):
+    print(title)
+    for layer_name in model_state_dict:
+        print(f"Layer {layer_name} shape: {model_state_dict[layer_name].shape}")
 
+def prune_row_maps(model_state_dict, graph, hyperparam_k=0.1, score='l2', score_kwargs=None):
+    # {layer: row_map} keeping all but the least important neurons (see find_indices_to_drop) of every resizable layer
+    score_kwargs = score_kwargs or {}
+    row_maps = {}
+    for name in graph.resizable:
+        indices_to_drop = find_indices_to_drop(model_state_dict, name, hyperparam_k, score, **score_kwargs)
+        if len(indices_to_drop) != 0:
+            weight = model_state_dict[name + '.weight']
+            mask = torch.ones(weight.shape[0], dtype=torch.bool, device=weight.device)
+            mask[indices_to_drop] = False
+            row_maps[name] = torch.nonzero(mask).squeeze(1)
+    return row_maps
+
+def expand_row_maps(model_state_dict, graph, hyperparam_e=0.1):
+    # {layer: row_map} appending int(hyperparam_e * width) new neurons (-1) to every resizable layer
+    row_maps = {}
+    for name in graph.resizable:
+        weight = model_state_dict[name + '.weight']
+        num_new_neurons = int(weight.shape[0] * hyperparam_e)
+        if num_new_neurons != 0:
+            row_maps[name] = torch.cat((torch.arange(weight.shape[0], device=weight.device), torch.full((num_new_neurons,), -1, device=weight.device)))
+    return row_maps
+
+def net2net_row_maps(model_state_dict, graph, hyperparam_e=0.1, split_noise=0.0):
+    # function preserving (Net2Net) growth : every new neuron of a resizable layer copies the incoming weights and bias
+    # of a random existing one, and the consumers read the k copies of a neuron through its old column divided by k,
+    # so the expanded model computes exactly the same function
+    # split_noise > 0 breaks the symmetry between the copies by splitting the column unevenly (still summing to 1 over the copies)
+    # returns the row_maps (-1 for the new neurons, as expand_row_maps), sources and col_scales of resize_linear_state_dict
+    row_maps, sources, col_scales = {}, {}, {}
+    for name in graph.resizable:
+        weight = model_state_dict[name + '.weight']
+        n_neurons = weight.shape[0]
+        num_new_neurons = int(n_neurons * hyperparam_e)
+        if num_new_neurons == 0:
+            continue
+        kept = torch.arange(n_neurons, device=weight.device)
+        row_maps[name] = torch.cat((kept, torch.full((num_new_neurons,), -1, device=weight.device)))
+        sources[name] = torch.cat((kept, torch.randint(n_neurons, (num_new_neurons,), device=weight.device)))
+        counts = torch.bincount(sources[name], minlength=n_neurons).to(weight.dtype)
+        scale = 1 / counts[sources[name]]
+        if split_noise > 0:
+            noise = torch.randn(scale.shape, device=weight.device, dtype=weight.dtype) * split_noise * scale
+            # zero mean over the copies of each neuron so that the fractions still sum to 1
+            noise_mean = torch.zeros(n_neurons, device=weight.device, dtype=weight.dtype).index_add_(0, sources[name], noise) / counts
+            scale = scale + noise - noise_mean[sources[name]]
+        col_scales[name] = scale
+    return row_maps, sources, col_scales
+
+EXPAND_MODES = ('perturb', 'net2net')
+
+def perturbation_fill(hyperparam_perturbation=0.01):
+    # fill_fn of resize_linear_state_dict drawing the new entries from N(0, hyperparam_perturbation^2)
+    return lambda shape, device, dtype: torch.randn(shape, device=device, dtype=dtype) * hyperparam_perturbation
 
 def prune_model(model_state_dict):
-    last_indices = []
-    for layer_name in list(model_state_dict.keys()):  # Convert to list to make a static copy of keys
-        prune_left = True
-        prune_right = True
-        # print("layer_name ", layer_name)
-        if 'fc' in layer_name and 'weight' in layer_name:
-            attribute_name = layer_name.split('.')[0]
-            base_layer_name = layer_name.rsplit('.', 1)[0]
-            indices_to_drop = find_indices_to_drop(model_state_dict, base_layer_name)
-            # print(f"Pruning {len(indices_to_drop)} neurons from {base_layer_name}")
-
-            device = model_state_dict[base_layer_name + '.weight'].device
-
-            # Creating a mask for all indices initially set to keep (True)
-            layer_shape = model_state_dict[base_layer_name + '.weight'].shape
-            # print("layer_shape ", layer_shape)
-            if layer_shape[1] == 794:
-                prune_right = False
-            if layer_shape[0] == 784:
-                prune_left = False
-
-            if prune_left:
-                # print("inside prune left")
-                total_indices = model_state_dict[base_layer_name + '.weight'].shape[0]
-                mask = torch.ones(total_indices, dtype=torch.bool, device=device)
-                mask[indices_to_drop] = False  # Setting indices to drop to False
-
-                # Applying mask to prune weights
-                pruned_weight = model_state_dict[base_layer_name + '.weight'][mask]
-                model_state_dict[base_layer_name + '.weight'] = pruned_weight
-
-                # Checking and applying mask to prune bias if it exists
-                if base_layer_name + '.bias' in model_state_dict:
-                    pruned_bias = model_state_dict[base_layer_name + '.bias'][mask]
-                    model_state_dict[base_layer_name + '.bias'] = pruned_bias
-
-                # print("Pruned weight shape: ", pruned_weight.shape)
-                # if base_layer_name + '.bias' in model_state_dict:
-                    # print("Pruned bias shape: ", pruned_bias.shape)
-            if prune_right and last_indices[-1]['total_indices'] == model_state_dict[base_layer_name + '.weight'].shape[1]:
-                # print("inside prune right")
-                total_indices = model_state_dict[base_layer_name + '.weight'].shape[1]
-                mask = torch.ones(total_indices, dtype=torch.bool, device=device)
-                mask[last_indices[-1]['indices_to_drop']] = False
-
-                # Applying mask to prune weights
-                pruned_weight = model_state_dict[base_layer_name + '.weight'][:, mask]
-                model_state_dict[base_layer_name + '.weight'] = pruned_weight
-
-                # print("Pruned weight shape: ", pruned_weight.shape)
-            
-            last_indices.append({'total_indices': total_indices, 'indices_to_drop': indices_to_drop})
-        # print the final shape of all the layers in the model
-    
-    #change all the layer names to remove the .0
-    for key in list(model_state_dict.keys()):
-        if '.0.' in key:
-            new_key = key.replace('.0.', '.')
-            model_state_dict[new_key] = model_state_dict.pop(key)
-
-    # for layer_name in model_state_dict:
-    #     print(f"Layer {layer_name} shape: {model_state_dict[layer_name].shape}")
-        
+    # kept for the old callers, same as prune_model_using_dag with its defaults
+    return prune_model_using_dag(model_state_dict)
+
+def prune_model_using_dag(model_state_dict, hyperparam_k = 0.1, type=1, return_index_maps=False, score='l2', score_kwargs=None, model=None):
+    # drops the least important neurons (see find_indices_to_drop) of every resizable layer of the traced graph of model
+    # (a OneHotCVAE built from model_state_dict if None) and the matching columns of their consumers
+    # with return_index_maps=True also returns the {layer: (row_map, col_map)} maps applied, see remap_tensor
+    # score / score_kwargs select the neuron importance, see neuron_importance
+    # type is kept for compatibility, fc1.0.weight style keys are renamed whatever its value
+    model_state_dict = normalize_keys(model_state_dict)
+    graph = trace_linear_graph(model if model is not None else model_from_state_dict(model_state_dict))
+    row_maps = prune_row_maps(model_state_dict, graph, hyperparam_k, score, score_kwargs)
+    model_state_dict, index_maps = resize_linear_state_dict(model_state_dict, graph, row_maps)
+    _print_shapes("after compression:", model_state_dict)
+
+    if return_index_maps:
+        return model_state_dict, index_maps
     return model_state_dict
 
-
-def prune_model_using_dag(model_state_dict, hyperparam_k = 0.1, type=1):
-    model_state_dict_copy = copy.deepcopy(model_state_dict)
-    dag = create_dag(model_state_dict, type=type)
-    if type == 1:
-        start_layer = "fc1.0.weight"
-    else :
-        start_layer = "fc1.weight"
-    layers_done = set([])
-    if type == 1:
-        layers_to_prune = list(dag.keys()) + ["fc6.0.weight"]
-    else :
-        layers_to_prune = list(dag.keys()) + ["fc6.weight"]
-    while len(layers_to_prune) != 0:
-        # get the first in the list
-        start_layer = layers_to_prune.pop(0)
-        prune_right = False
-        # print("start_layer ", start_layer)
-        attribute_name = start_layer.split('.')[0]
-        base_layer_name = start_layer.rsplit('.', 1)[0]
-
-        device = model_state_dict[base_layer_name + '.weight'].device
-
-        layer_shape = model_state_dict[base_layer_name + '.weight'].shape
-        # print("layer_shape ", layer_shape)
-        # check if this layer has any parent in the dag
-        parent_layer = None
-        for key in dag:
-            if start_layer in dag[key]:
-                parent_layer = key
-                break
-        if parent_layer is not None:
-            if parent_layer in layers_done:
-                indices_to_drop2 = find_indices_to_drop(model_state_dict_copy, parent_layer.rsplit('.', 1)[0], hyperparam_k)
-                prune_right = True
-            else:
-                prune_right = False
-        
-        indices_to_drop = find_indices_to_drop(model_state_dict, base_layer_name, hyperparam_k)
-        # print(f"Pruning {len(indices_to_drop)} neurons from {base_layer_name}")
-
-        # drop the first dimension
-        if len(indices_to_drop) != 0:
-            if base_layer_name + '.weight' in model_state_dict:
-                total_indices = model_state_dict[base_layer_name + '.weight'].shape[0]
-                mask = torch.ones(total_indices, dtype=torch.bool, device=device)
-                mask[indices_to_drop] = False
-
-                pruned_weight = model_state_dict[base_layer_name + '.weight'][mask]
-                model_state_dict[base_layer_name + '.weight'] = pruned_weight
-
-                if base_layer_name + '.bias' in model_state_dict:
-                    pruned_bias = model_state_dict[base_layer_name + '.bias'][mask]
-                    model_state_dict[base_layer_name + '.bias'] = pruned_bias
-
-                # print("Pruned weight shape: ", pruned_weight.shape)
-                # if base_layer_name + '.bias' in model_state_dict:
-                    # print("Pruned bias shape: ", pruned_bias.shape)
-        
-        # drop the second dimension
-        if prune_right:
-            if base_layer_name + '.weight' in model_state_dict:
-                total_indices = model_state_dict[base_layer_name + '.weight'].shape[1]
-                mask = torch.ones(total_indices, dtype=torch.bool, device=device)
-                mask[indices_to_drop2] = False
-
-                pruned_weight = model_state_dict[base_layer_name + '.weight'][:, mask]
-                model_state_dict[base_layer_name + '.weight'] = pruned_weight
-
-                # print("Pruned weight shape: ", pruned_weight.shape)
-        layers_done.add(start_layer)
-    
-    for key in list(model_state_dict.keys()):
-        if '.0.' in key:
-            new_key = key.replace('.0.', '.')
-            model_state_dict[new_key] = model_state_dict.pop(key)
-    # print the final shape of all the layers in the model
-    print("after compression:")
-    for layer_name in model_state_dict:
-        print(f"Layer {layer_name} shape: {model_state_dict[layer_name].shape}")
-
+def _expansion(model_state_dict, graph, hyperparam_e, hyperparam_perturbation, mode, split_noise):
+    # (row_maps, keyword arguments of resize_linear_state_dict) of an expansion mode of EXPAND_MODES
+    if mode == 'net2net':
+        row_maps, sources, col_scales = net2net_row_maps(model_state_dict, graph, hyperparam_e, split_noise)
+        return row_maps, {'sources': sources, 'col_scales': col_scales}
+    if mode != 'perturb':
+        raise ValueError(f"Unknown expansion mode {mode}, expected one of {EXPAND_MODES}")
+    return expand_row_maps(model_state_dict, graph, hyperparam_e), {'fill_fn': perturbation_fill(hyperparam_perturbation)}
+
+def expand_model(model_state_dict, hyperparam_e = 0.1, hyperparam_perturbation=0.01, type=2, return_index_maps=False, model=None, mode='perturb', split_noise=0.0):
+    # adds int(hyperparam_e * width) neurons to every resizable layer of the traced graph (see prune_model_using_dag)
+    # mode='perturb' : their weights, biases and the new columns of the consumers are N(0, hyperparam_perturbation^2)
+    # mode='net2net' : they are split off existing neurons and the function is preserved, see net2net_row_maps
+    # with return_index_maps=True also returns the {layer: (row_map, col_map)} maps applied, -1 marks the new neurons
+    model_state_dict = normalize_keys(model_state_dict)
+    graph = trace_linear_graph(model if model is not None else model_from_state_dict(model_state_dict))
+    row_maps, resize_kwargs = _expansion(model_state_dict, graph, hyperparam_e, hyperparam_perturbation, mode, split_noise)
+    model_state_dict, index_maps = resize_linear_state_dict(model_state_dict, graph, row_maps, **resize_kwargs)
+    _print_shapes("after expansion:", model_state_dict)
+
+    if return_index_maps:
+        return model_state_dict, index_maps
     return model_state_dict
 
-def expand_model(model_state_dict, hyperparam_e = 0.1, hyperparam_perturbation=0.01, type=2): # hardcoded for now ... , may write comprehensive code for this later!
-    model_state_dict_copy = copy.deepcopy(model_state_dict)
-    dag = create_dag(model_state_dict, type=type)
-    if type == 2:
-        start_layer = "fc1.weight"
-    else : 
-        start_layer = "fc1.0.weight"
-    layers_done = set([])
-    if type == 2:
-        layers_to_expand = list(dag.keys()) + ["fc6.weight"]
-    else : 
-        layers_to_expand = list(dag.keys()) + ["fc6.0.weight"]
-    while len(layers_to_expand) != 0:
-        start_layer = layers_to_expand.pop(0)
-        expand_right = False
-        # print("start_layer ", start_layer)
-        attribute_name = start_layer.split('.')[0]
-        base_layer_name = start_layer.rsplit('.', 1)[0]
-
-        device = model_state_dict[base_layer_name + '.weight'].device
-
-        layer_shape = model_state_dict[base_layer_name + '.weight'].shape
-        # print("layer_shape ", layer_shape)
-        # check if this layer has any parent in the dag
-        parent_layer = None
-        for key in dag:
-            if start_layer in dag[key]:
-                parent_layer = key
-                break
-        if parent_layer is not None:
-            if parent_layer in layers_done:
-                amount_to_expand2 = model_state_dict_copy[parent_layer.rsplit('.', 1)[0] + '.weight'].shape[0]*hyperparam_e
-                # print("amount_to_expand2 ", amount_to_expand2)
-                expand_right = True
-            else:
-                expand_right = False
-        
-        amount_to_expand = model_state_dict_copy[base_layer_name + '.weight'].shape[0]*hyperparam_e
-        # print(f"Expanding {amount_to_expand} neurons from {base_layer_name}")
-
-        # expand the first dimension
-        if int(amount_to_expand) != 0 and base_layer_name != 'fc6' and base_layer_name != 'fc31' and base_layer_name != 'fc32':
-            if base_layer_name + '.weight' in model_state_dict:
-                num_new_neurons = int(amount_to_expand)
-                new_weights = (torch.randn(num_new_neurons, model_state_dict[base_layer_name + '.weight'].shape[1])*hyperparam_perturbation).to(device)
-                expanded_weights = torch.cat((model_state_dict[base_layer_name + '.weight'], new_weights), dim=0)
-                model_state_dict[base_layer_name + '.weight'] = expanded_weights
-
-                if base_layer_name + '.bias' in model_state_dict:
-                    new_bias = (torch.randn(num_new_neurons)*hyperparam_perturbation).to(device)
-                    expanded_bias = torch.cat((model_state_dict[base_layer_name + '.bias'], new_bias), dim=0)
-                    model_state_dict[base_layer_name + '.bias'] = expanded_bias
-        
-        # expand the second dimension
-        if expand_right:
-            # print("inside expand right")
-            # print("parent_layer ", parent_layer)
-            if base_layer_name + '.weight' in model_state_dict:
-                num_new_neurons = int(amount_to_expand2)
-                new_weights = (torch.randn(model_state_dict[base_layer_name + '.weight'].shape[0], num_new_neurons)*hyperparam_perturbation).to(device)
-                expanded_weights = torch.cat((model_state_dict[base_layer_name + '.weight'], new_weights), dim=1)
-                model_state_dict[base_layer_name + '.weight'] = expanded_weights
-
-                # print("Expanded weight shape: ", expanded_weights.shape)
-        layers_done.add(start_layer)
-
-    for key in list(model_state_dict.keys()):
-        if '.0.' in key:
-            new_key = key.replace('.0.', '.')
-            model_state_dict[new_key] = model_state_dict.pop(key)
-
-    # print the final shape of all the layers in the model
-    print("after expansion:")
-    for layer_name in model_state_dict:
-        print(f"Layer {layer_name} shape: {model_state_dict[layer_name].shape}")
-
-    return model_state_dict
+def _remap_optimizer_param(optimizer, old_param, new_param, row_map, col_map):
+    # points the optimizer at new_param and carries the per-parameter state of old_param over through the same maps,
+    # state tensors shaped like the parameter (Adam's exp_avg / exp_avg_sq, ...) start at zero for the new neurons,
+    # the others (step) are kept as they are
+    for group in optimizer.param_groups:
+        group['params'] = [new_param if param is old_param else param for param in group['params']]
+    state = optimizer.state.pop(old_param, None)
+    if state:
+        optimizer.state[new_param] = {
+            key: remap_tensor(value, row_map, col_map) if torch.is_tensor(value) and value.shape == old_param.shape else value
+            for key, value in state.items()
+        }
+
+def resize_model_(model, row_maps, fill_fn=None, optimizer=None, graph=None, sources=None, col_scales=None):
+    # in place version of resize_linear_state_dict on a live model : the resized Linear layers get new parameters,
+    # the optimizer (if any) follows them with its state remapped, and so do the selective dropout masks
+    # returns the {layer: (row_map, col_map)} maps applied
+    graph = graph if graph is not None else trace_linear_graph(model)
+    params = {name: param.detach() for name, param in model.named_parameters()}
+    resized, index_maps = resize_linear_state_dict(params, graph, row_maps, fill_fn, sources, col_scales)
+    for name, (row_map, col_map) in index_maps.items():
+        module = model.get_submodule(name)
+        for param_name in ('weight', 'bias'):
+            old_param = getattr(module, param_name)
+            if old_param is None:
+                continue
+            new_param = nn.Parameter(resized[f"{name}.{param_name}"], requires_grad=old_param.requires_grad)
+            setattr(module, param_name, new_param)
+            if optimizer is not None:
+                _remap_optimizer_param(optimizer, old_param, new_param, row_map, col_map if param_name == 'weight' else None)
+        module.out_features, module.in_features = module.weight.shape
+        selective_dropout = getattr(model, 'selective_dropout', {})
+        if row_map is not None and name in selective_dropout:
+            dropout_layer = selective_dropout[name]
+            dropout_layer.neuron_mask = remap_tensor(dropout_layer.neuron_mask, row_map)
+            dropout_layer.n_selected = int(dropout_layer.neuron_mask.sum())
+    return index_maps
+
+def prune_model_(model, hyperparam_k=0.1, optimizer=None, score='l2', score_kwargs=None):
+    # prune_model_using_dag on the live model (and optimizer state), returns the index maps
+    graph = trace_linear_graph(model)
+    row_maps = prune_row_maps(model.state_dict(), graph, hyperparam_k, score, score_kwargs)
+    index_maps = resize_model_(model, row_maps, optimizer=optimizer, graph=graph)
+    _print_shapes("after compression:", model.state_dict())
+    return index_maps
+
+def expand_model_(model, hyperparam_e=0.1, hyperparam_perturbation=0.01, optimizer=None, mode='perturb', split_noise=0.0):
+    # expand_model on the live model (and optimizer state), returns the index maps
+    graph = trace_linear_graph(model)
+    row_maps, resize_kwargs = _expansion(model.state_dict(), graph, hyperparam_e, hyperparam_perturbation, mode, split_noise)
+    index_maps = resize_model_(model, row_maps, optimizer=optimizer, graph=graph, **resize_kwargs)
+    _print_shapes("after expansion:", model.state_dict())
+    return index_maps
+
+def prune_masked_(model, hyperparam_k=0.1, score='l2', score_kwargs=None, optimizer=None):
+    # prune_model_ for a CapacityCVAE : the least important active neurons of every hidden layer are masked out,
+    # no parameter or optimizer state is reallocated (nor remapped, the shapes stay the same), the optimizer state of
+    # the consumer columns of the pruned neurons is zeroed
+    score_kwargs = score_kwargs or {}
+    model_state_dict = {name: param.detach() for name, param in model.named_parameters()}
+    for name in model.extents:
+        active = model.active_indices(name)
+        scores = neuron_importance(model_state_dict, name, score, **score_kwargs)[active]
+        model.prune_neurons_(name, active[bottom_k_indices(scores, hyperparam_k)], optimizer)
+    print("after compression, active neurons:", {name: model.active_width(name) for name in model.extents})
+
+def grow_masked_(model, hyperparam_e=0.1, hyperparam_perturbation=0.01, optimizer=None):
+    # expand_model_ for a CapacityCVAE : int(hyperparam_e * active width) free slots of every hidden layer are activated
+    for name in model.extents:
+        num_new_neurons = int(model.active_width(name) * hyperparam_e)
+        if num_new_neurons != 0:
+            model.grow_neurons_(name, num_new_neurons, hyperparam_perturbation, optimizer)
+    print("after expansion, active neurons:", {name: model.active_width(name) for name in model.extents})
+
+def export_model(model):
+    # (state_dict to save, {layer: (row_map, col_map)} maps from the model's parameters to it) : a CapacityCVAE is
+    # compacted to its active neurons (see CapacityCVAE.compact), any other model is saved as is with no maps
+    if isinstance(model, CapacityCVAE):
+        compacted, index_maps = model.compact()
+        return compacted.state_dict(), index_maps
+    return model.state_dict(), {}
+
+def remap_tensor(tensor, row_map=None, col_map=None, fill=None):
+    # re-indexes a weight / bias shaped tensor through the maps returned by prune_model_using_dag and expand_model :
+    # entry (i, j) of the result is the old entry (row_map[i], col_map[j]), a None map leaves that dimension as is
+    # and positions mapped from -1 belong to new neurons, they take the matching entry of fill (zeros if None)
+    is_new = torch.zeros((), dtype=torch.bool, device=tensor.device)
+    if row_map is not None:
+        row_map = row_map.to(tensor.device)
+        tensor = tensor.index_select(0, row_map.clamp(min=0))
+        is_new = is_new | (row_map < 0).view((-1,) + (1,) * (tensor.dim() - 1))
+    if col_map is not None and tensor.dim() > 1:
+        col_map = col_map.to(tensor.device)
+        tensor = tensor.index_select(1, col_map.clamp(min=0))
+        is_new = is_new | (col_map < 0)
+    if not is_new.any():
+        return tensor
+    fill = torch.zeros_like(tensor) if fill is None else fill.to(device=tensor.device, dtype=tensor.dtype)
+    return torch.where(is_new, fill, tensor)
+
+def remap_param_dict(param_dict, index_maps, fill_dict=None):
+    # applies remap_tensor to every entry of a {param_name: tensor} dict (Fisher, MLE parameters, ...)
+    # fill_dict, e.g. the parameters of the resized model, gives the values of the new neurons, zeros otherwise
+    remapped = {}
+    for name, tensor in param_dict.items():
+        row_map, col_map = index_maps.get(name.rsplit('.', 1)[0], (None, None))
+        fill = None if fill_dict is None else fill_dict[name]
+        remapped[name] = remap_tensor(tensor, row_map, col_map, fill)
+    return remapped
+
+# the parameters vae.decoder needs, enough to sample from a checkpoint
+DECODER_PARAMS = ['fc4.weight', 'fc4.bias', 'fc5.weight', 'fc5.bias', 'fc6.weight', 'fc6.bias']
 
 def generate_samples(ckpt_path, sample_path, classes_remembered, classes_not_remembered, n_samples=100, batch_size=32):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    ckpt = torch.load(os.path.join(ckpt_path), map_location=device)
+    if os.path.isdir(ckpt_path):
+        ckpt_path = os.path.join(ckpt_path, "ckpt_modified")
+    # only the decoder tensors are mapped from a .tensors checkpoint, the encoder is never used here
+    ckpt = load_checkpoint(ckpt_path, names=DECODER_PARAMS, groups=(), device=device)
     config = ckpt['config']
     # build model
     vae = OneHotCVAE(x_dim=config.x_dim, h_dim1= ckpt['h_dims1'], h_dim2=ckpt['h_dims2'], z_dim=config.z_dim)
     vae = vae.to(device)
+    # the decoder layers may have been resized independently of h_dims1 / h_dims2
+    fit_linear_shapes_(vae, ckpt['model'])
     
-    vae.load_state_dict(ckpt['model'])
+    vae.load_state_dict(ckpt['model'], strict=False)
     vae.eval()
     
     for cls in classes_remembered:
@@ -563,7 +833,7 @@ def evaluate_with_classifier(ckpt_path, classifier_path, classes_remembered, cla
 
 def generate_samples_specialized_model(ckpt_folder, ckpt_name, sample_path, classes_remembered, classes_not_remembered, n_samples=100, batch_size=32):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    ckpt = torch.load(os.path.join(ckpt_folder, ckpt_name), map_location=device)
+    ckpt = load_checkpoint(os.path.join(ckpt_folder, ckpt_name), device=device)
     config = ckpt['config']
     print(ckpt.keys())
     # build model